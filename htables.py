@@ -1,3 +1,4 @@
+from __future__ import with_statement
 try:
     import simplejson as json
 except ImportError:
@@ -6,9 +7,18 @@ import random
 import StringIO
 import warnings
 import re
+import os
 import os.path
+import tempfile
+import zlib
+import base64
+import hashlib
+import itertools
+import threading
+import time
 from contextlib import contextmanager
 import logging
+import operator
 
 log = logging.getLogger(__name__)
 
@@ -44,8 +54,21 @@ class MissingTable(RuntimeError):
     """ Table missing from database. """
 
 
+class PoolTimeout(RuntimeError):
+    """ No database connection became available in time. """
+
+
 COPY_BUFFER_SIZE = 2 ** 14
 
+# blobs, compressed rows and binary rows start with this header, followed
+# by a format byte (see `_row_formats`, or `b` for blobs) and a compression
+# byte; it's written on all blobs, so their data is never mistaken for it
+COMPRESSION_HEADER = '\x00ht'
+
+_blob_header_size = len(COMPRESSION_HEADER) + 2
+
+_compression_tags = {None: '-', 'zlib': 'z', 'zstd': 's'}
+
 
 class op(object):
     """ Container for `where` operators """
@@ -68,11 +91,105 @@ class op(object):
         def __init__(self, **by_dialect):
             self.__dict__.update(by_dialect)
 
+    class In(object):
+        """ Equal to one of `values` """
+
+        def __init__(self, values):
+            self.values = list(values)
+
+    class Ne(object):
+        """ Not equal to `value`; rows without the key also match """
+
+        def __init__(self, value):
+            self.value = value
+
+    class _Compare(object):
+
+        def __init__(self, value):
+            self.value = value
+
+    class Gt(_Compare):
+        """ Greater than `value` """
+        operator = '>'
+
+    class Ge(_Compare):
+        """ Greater than or equal to `value` """
+        operator = '>='
+
+    class Lt(_Compare):
+        """ Less than `value` """
+        operator = '<'
+
+    class Le(_Compare):
+        """ Less than or equal to `value` """
+        operator = '<='
+
+    class Range(object):
+        """ From `start` (inclusive) to `end` (exclusive); a bound that is
+        `None` is left open """
+
+        def __init__(self, start=None, end=None):
+            self.start = start
+            self.end = end
+
+    class Prefix(object):
+        """ String that starts with `prefix` """
+
+        def __init__(self, prefix):
+            self.prefix = prefix
+
+    class Exists(object):
+        """ The row has the key, with any value """
+
+    class Or(object):
+        """ Rows that match any of the `where` dicts; use it instead of a
+        `dict` as the `where` argument of :meth:`Table.query` """
+
+        def __init__(self, *wheres):
+            self.wheres = wheres
+
+
+def _comparisons(value):
+    """ List of `(operator, value)` comparisons that make up a
+    :class:`op.Range` or a comparison operator. """
+    if isinstance(value, op._Compare):
+        return [(value.operator, value.value)]
+    comparisons = []
+    if value.start is not None:
+        comparisons.append(('>=', value.start))
+    if value.end is not None:
+        comparisons.append(('<', value.end))
+    return comparisons
+
+
+_python_operators = {
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+}
+
 
-def _iter_file(src_file, close=False):
+def _prefix_end(prefix):
+    """ The smallest string greater than all strings that start with
+    `prefix`, or `None` if there is no such string. """
+    prefix = prefix.decode('utf-8') if isinstance(prefix, str) else prefix
+    if not prefix or ord(prefix[-1]) >= 0xffff:
+        return None
+    return prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+
+
+def _iter_file(src_file, close=False, chunk_size=COPY_BUFFER_SIZE,
+               length=None):
+    """ Read `src_file` in blocks of `chunk_size` bytes, stopping after
+    `length` bytes if it's not `None`. """
     try:
-        while True:
-            block = src_file.read()
+        while length is None or length > 0:
+            if length is None:
+                block = src_file.read(chunk_size)
+            else:
+                block = src_file.read(min(chunk_size, length))
+                length -= len(block)
             if not block:
                 break
             yield block
@@ -81,10 +198,297 @@ def _iter_file(src_file, close=False):
             src_file.close()
 
 
+def _compressor(compress):
+    """ Streaming compressor for the `compress` algorithm, with `compress`
+    and `flush` methods. """
+    if compress == 'zlib':
+        return zlib.compressobj()
+    elif compress == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor().compressobj()
+    raise ValueError("Unknown compression %r" % compress)
+
+
+def _decompressor(tag):
+    if tag == '-':
+        return None
+    elif tag == 'z':
+        return zlib.decompressobj()
+    elif tag == 's':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError("Unknown compression tag %r" % tag)
+
+
+def _msgpack():
+    import msgpack
+    return msgpack
+
+
+def _msgpack_dumps(obj):
+    # byte strings are stored like `unicode` ones, as UTF-8 text, so they
+    # are loaded back as `unicode`, like with JSON
+    return _msgpack().packb(obj, use_bin_type=False)
+
+
+def _msgpack_loads(data):
+    return _msgpack().unpackb(data, raw=False)
+
+
+# row codecs supported by SQLite: name -> (format byte, dumps, loads)
+_row_formats = {
+    'json': ('j', json.dumps, json.loads),
+    'msgpack': ('m', _msgpack_dumps, _msgpack_loads),
+}
+
+_row_loads = dict((fmt, loads) for fmt, dumps, loads in _row_formats.values())
+
+
+def _blob_blocks(blocks, compress):
+    """ Blocks to store for a blob with the data in `blocks`: the header,
+    then the data, compressed if `compress` is not `None`. """
+    if compress is None:
+        yield COMPRESSION_HEADER + 'b' + _compression_tags[None]
+        for block in blocks:
+            yield block
+        return
+    compressor = _compressor(compress)
+    yield COMPRESSION_HEADER + 'b' + _compression_tags[compress]
+    for block in blocks:
+        data = compressor.compress(block)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _read_blob_header(src_file):
+    """ Read the header from the start of blob file `src_file`. Return the
+    compression tag of the data, and the position where the data starts.
+    Blobs saved by older versions have no header and are not compressed. """
+    header = src_file.read(_blob_header_size)
+    if (len(header) == _blob_header_size and
+            header[:-1] == COMPRESSION_HEADER + 'b' and
+            header[-1] in _compression_tags.values()):
+        return header[-1], _blob_header_size
+    return _compression_tags[None], 0
+
+
+def _slice_blocks(blocks, offset, length, chunk_size):
+    """ Cut a stream of blocks into blocks of `chunk_size` bytes, skipping
+    the first `offset` bytes and stopping after `length` bytes. """
+    pending = []  # collected until there is at least one whole chunk
+    pending_size = 0
+    remaining = length
+    for block in blocks:
+        if offset:
+            skipped = len(block[:offset])
+            block = block[offset:]
+            offset -= skipped
+        if remaining is not None:
+            block = block[:remaining]
+            remaining -= len(block)
+        if block:
+            pending.append(block)
+            pending_size += len(block)
+        if pending_size >= chunk_size:
+            data = ''.join(pending)
+            start = 0
+            while pending_size - start >= chunk_size:
+                yield data[start:start + chunk_size]
+                start += chunk_size
+            pending = [data[start:]]
+            pending_size -= start
+        if remaining == 0:
+            break
+    if pending_size:
+        yield ''.join(pending)
+
+
+def _iter_blob(src_file, offset=0, length=None, chunk_size=COPY_BUFFER_SIZE):
+    """ Read a blob from `src_file`, positioned at its start, decompressing
+    it if its header says so. `offset` and `length` count uncompressed
+    bytes. The file is closed at the end. """
+    tag, start = _read_blob_header(src_file)
+    if tag == _compression_tags[None]:
+        src_file.seek(start + offset)
+        return _iter_file(src_file, close=True, chunk_size=chunk_size,
+                          length=length)
+
+    blocks = _decompress_blocks(src_file, tag, chunk_size)
+    return _slice_blocks(blocks, offset, length, chunk_size)
+
+
+def _decompress_blocks(src_file, tag, chunk_size):
+    """ Decompress the rest of `src_file` into blocks of at most
+    `chunk_size` bytes, so that highly compressible data is never expanded
+    in memory all at once. The file is closed at the end. """
+    if tag == 's':
+        import zstandard
+        try:
+            for data in zstandard.ZstdDecompressor().read_to_iter(
+                    src_file, read_size=chunk_size, write_size=chunk_size):
+                yield data
+        finally:
+            src_file.close()
+        return
+    decompressor = _decompressor(tag)
+    for block in _iter_file(src_file, close=True, chunk_size=chunk_size):
+        while True:
+            data = decompressor.decompress(block, chunk_size)
+            if data:
+                yield data
+            block = decompressor.unconsumed_tail
+            # a full chunk may leave more output pending, even when all
+            # the input was consumed
+            if not block and len(data) < chunk_size:
+                break
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+def _iter_cursor(cursor, fetch_size):
+    cursor.arraysize = fetch_size
+    while True:
+        rows = cursor.fetchmany()
+        if not rows:
+            break
+        for row in rows:
+            yield row
+
+
+_cursor_names = itertools.count(1)
+
+
+def _parse_order_by(order_by):
+    """ Return the sort field and direction for the `order_by` argument of
+    :meth:`Table.query`. """
+    if not order_by:
+        return None, False
+    elif isinstance(order_by, basestring):
+        return order_by, False
+    elif isinstance(order_by, op.Reversed):
+        return order_by.field, True
+    else:
+        raise RuntimeError("Unknown operator %r" % order_by)
+
+
+def _keyset_condition(expr, after, reverse, nulls_first, literal):
+    """ SQL condition that matches the rows coming after `after` when
+    sorting by `expr` and then by `id`. `after` is ``(value, id)``, or
+    just ``(id,)`` when sorting by `id` alone. `nulls_first` tells where
+    the database places rows with a NULL `expr`; `literal` renders a Python
+    value as SQL. """
+    if len(after) == 1:
+        [obj_id] = after
+        return "id > %s" % literal(obj_id)
+    value, obj_id = after
+    if value is None:
+        if nulls_first:
+            return "(%s IS NOT NULL OR id > %s)" % (expr, literal(obj_id))
+        else:
+            return "(%s IS NULL AND id > %s)" % (expr, literal(obj_id))
+    condition = "(%s %s %s OR (%s = %s AND id > %s)" % (
+        expr, '<' if reverse else '>', literal(value),
+        expr, literal(value), literal(obj_id))
+    if not nulls_first:
+        condition += " OR %s IS NULL" % expr
+    return condition + ")"
+
+
+def _encode_page_token(after):
+    return base64.urlsafe_b64encode(json.dumps(after))
+
+
+def _decode_page_token(token, ordered):
+    """ Decode a token made by :func:`_encode_page_token`: ``[id]``, or
+    ``[value, id]`` if the query is `ordered`. """
+    try:
+        after = json.loads(base64.urlsafe_b64decode(str(token)))
+    except (TypeError, ValueError):
+        raise ValueError("Invalid page token %r" % token)
+    if not (isinstance(after, list) and len(after) == (2 if ordered else 1)):
+        raise ValueError("Invalid page token %r" % token)
+    obj_id = after[-1]
+    if isinstance(obj_id, bool) or not isinstance(obj_id, (int, long)):
+        raise ValueError("Invalid page token %r" % token)
+    # the sort value can be anything that a row holds
+    return tuple(after)
+
+
 def _postgresql_quote(string):
     return "'%s'" % string.replace("'", "''")
 
 
+def _postgresql_key(key):
+    """ SQL expression for the value of `key`, escaped for use in a query
+    with parameters. Values are compared in the "C" collation, character
+    by character like SQLite does, which is how key indexes are built, so
+    prefix and range queries and sorting can use them whatever the
+    database collation is. """
+    return '((data -> %s) COLLATE "C")' % (
+        _postgresql_quote(key).replace('%', '%%'))
+
+
+_postgresql_connection_cls = None
+
+
+def _get_postgresql_connection_cls():
+    """ psycopg2 connection class that can hold per-connection state. """
+    global _postgresql_connection_cls
+    if _postgresql_connection_cls is None:
+        class connection(psycopg2.extensions.connection):
+            _htables_statements = None
+        _postgresql_connection_cls = connection
+    return _postgresql_connection_cls
+
+
+def _index_name(table_name, key):
+    safe_key = re.sub(r'[^a-zA-Z0-9_]', '_', key)
+    if safe_key != key:
+        # keep names unique for keys that differ only in special characters
+        safe_key += '_%08x' % (zlib.crc32(key.encode('utf-8')) & 0xffffffff)
+    return '%s_%s_idx' % (table_name, safe_key)
+
+
+_sqlite_json1 = None
+
+
+def _sqlite_has_json1():
+    """ Check if the SQLite library was built with the JSON1 functions. """
+    global _sqlite_json1
+    if _sqlite_json1 is None:
+        import sqlite3
+        try:
+            sqlite3.connect(':memory:').execute("SELECT json('{}')")
+        except sqlite3.OperationalError:
+            _sqlite_json1 = False
+        else:
+            _sqlite_json1 = True
+    return _sqlite_json1
+
+
+def _sqlite_regexp(pattern, value):
+    if value is None:
+        value = ''
+    return re.search(pattern, value) is not None
+
+
+def _sqlite_connect(uri, pragmas={}, on_connect=None, **kwargs):
+    import sqlite3
+    conn = sqlite3.connect(uri, **kwargs)
+    conn.create_function('regexp', 2, _sqlite_regexp)
+    for name, value in sorted(pragmas.items()):
+        if re.match(r'^\w+$', name) is None:
+            raise ValueError("Invalid pragma name %r" % name)
+        if isinstance(value, basestring):
+            value = _postgresql_quote(value)
+        conn.execute("PRAGMA %s = %s" % (name, value))
+    if on_connect is not None:
+        on_connect(conn)
+    return conn
+
+
 class Row(dict):
     """ Database row, represented as a Python `dict`.
 
@@ -95,14 +499,41 @@ class Row(dict):
 
     id = None
 
+    _indexes = ()
+
+    _compress = None
+
+    # copy of the data last loaded from or saved to the database
+    _saved = None
+
     def delete(self):
         """ Execute a `DELETE` query for this row. """
         self._parent_table.delete(self.id, _deprecation_warning=False)
 
     def save(self):
-        """ Execute an `UPDATE` query for this row. """
+        """ Execute an `UPDATE` query for this row. Only the keys that were
+        changed or removed since the row was loaded are written; if there
+        are none, no query is made. """
         self._parent_table.save(self, _deprecation_warning=False)
 
+    def _changes(self):
+        """ Return a `dict` of the values that changed since the row was
+        loaded and a list of the keys that were removed. Values of mutable
+        types may have been changed in place, so they always count as
+        changed. """
+        saved = self._saved
+        changed = {}
+        for key, value in self.iteritems():
+            if not isinstance(value, _immutable_types):
+                changed[key] = value
+            elif key not in saved or saved[key] != value:
+                changed[key] = value
+        removed = [key for key in saved if key not in self]
+        return changed, removed
+
+
+_immutable_types = (basestring, int, long, float, bool, type(None))
+
 
 TableRow = Row
 
@@ -114,27 +545,380 @@ class DbFile(object):
     .. attribute:: id
 
         Unique ID of the file. It can be used to request the file later
-        via :meth:`Session.get_db_file`.
+        via :meth:`Session.get_db_file`. If the database deduplicates
+        blobs, the id may change when calling :meth:`save_from`.
     """
 
     def __init__(self, session, id):
         self.id = id
         self._session = session
 
-    def save_from(self, in_file):
+    def save_from(self, in_file, chunk_size=COPY_BUFFER_SIZE, compress=None):
         """ Consume data from `in_file` (a file-like object) and save to
-        database. """
-        lobject = self._session.conn.lobject(self.id, 'wb')
+        database. Data is copied in blocks of `chunk_size` bytes. If
+        `compress` is ``'zlib'`` (or ``'zstd'``, if the `zstandard` package
+        is installed), the data is compressed as it's saved; it's
+        decompressed transparently by :meth:`iter_data`. """
+        session = self._session
+        digest = None
+        if session._dedup_blobs:
+            digest = hashlib.sha256()
+            if session._release_blob(self.id):
+                # the old content may be shared; write to a new object
+                self.id = session.conn.lobject(mode='n').oid
+        blocks = _blob_blocks(_iter_file(in_file, chunk_size=chunk_size),
+                              compress)
+        lobject = session.conn.lobject(self.id, 'wb')
         try:
-            for block in _iter_file(in_file):
+            lobject.truncate()
+            for block in blocks:
+                if digest is not None:
+                    digest.update(block)
                 lobject.write(block)
         finally:
             lobject.close()
-
-    def iter_data(self):
-        """ Read data from database and return it as a Python generator. """
+        if digest is not None:
+            self.id = session._dedup_blob(self.id, digest.hexdigest())
+
+    def iter_data(self, offset=0, length=None, chunk_size=COPY_BUFFER_SIZE):
+        """ Read data from database and return it as a Python generator of
+        blocks of at most `chunk_size` bytes. Reading starts at byte
+        `offset` and stops after `length` bytes, if given, which is useful
+        for serving HTTP range requests. """
         lobject = self._session.conn.lobject(self.id, 'rb')
-        return _iter_file(lobject, close=True)
+        return _iter_blob(lobject, offset, length, chunk_size)
+
+
+class RowCache(object):
+    """ Read-through cache for rows and query results, shared by all the
+    sessions of a database; pass it as the `cache` argument of
+    :class:`PostgresqlDB` or :class:`SqliteDB`. At most `max_size` entries
+    are kept, evicting the least recently used ones, and each entry
+    expires after `ttl` seconds (or never, if `ttl` is `None`).
+
+    Writes made through :class:`Table` invalidate the entries of their
+    table, so the cache only goes stale if other processes modify the
+    database. Each invalidation also bumps the table's :meth:`generation`;
+    a value read from the database before that is not stored by
+    :meth:`set`, since it may predate the write.
+
+    .. attribute:: hits
+
+        Number of lookups answered from the cache.
+
+    .. attribute:: misses
+
+        Number of lookups that had to query the database.
+    """
+
+    def __init__(self, max_size=1000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._by_table = {}
+        self._generations = {}
+        self._clears = 0
+        # circular doubly linked list of [prev, next, key], oldest first
+        self._root = []
+        self._root[:] = [self._root, self._root, None]
+
+    def get(self, key):
+        """ Return the value cached for `key`, or `None`. """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                link, value, expires = entry
+                if expires is not None and expires < time.time():
+                    self._remove(key)
+                else:
+                    self._unlink(link)
+                    self._append(link)
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return None
+
+    def generation(self, table_name):
+        """ Return a token that changes each time the entries of table
+        `table_name` are invalidated. Read it before querying the database,
+        and pass it to :meth:`set`. """
+        with self._lock:
+            return (self._clears, self._generations.get(table_name, 0))
+
+    def set(self, key, value, generation=None):
+        """ Store `value` for `key`. The first item of `key` must be the
+        name of the table that `value` was read from. If `generation` is
+        given and the table was invalidated since it was returned by
+        :meth:`generation`, `value` may be stale and is not stored. """
+        expires = None if self.ttl is None else time.time() + self.ttl
+        with self._lock:
+            if generation is not None and generation != (
+                    self._clears, self._generations.get(key[0], 0)):
+                return
+            if key in self._entries:
+                self._remove(key)
+            link = [None, None, key]
+            self._append(link)
+            self._entries[key] = (link, value, expires)
+            self._by_table.setdefault(key[0], set()).add(key)
+            while len(self._entries) > self.max_size:
+                self._remove(self._root[1][2])
+                self.evictions += 1
+
+    def invalidate(self, table_name, obj_id=None):
+        """ Forget the cached query results of table `table_name`, and the
+        cached row `obj_id`; if `obj_id` is `None`, forget all rows. """
+        with self._lock:
+            self._generations[table_name] = (
+                self._generations.get(table_name, 0) + 1)
+            for key in list(self._by_table.get(table_name, ())):
+                if key[1] == 'query' or obj_id is None or key[2] == obj_id:
+                    self._remove(key)
+
+    def clear(self):
+        """ Remove all entries. """
+        with self._lock:
+            self._clears += 1
+            for key in list(self._entries):
+                self._remove(key)
+
+    def stats(self):
+        """ Return a `dict` with the `hits`, `misses` and `evictions`
+        counters, and the current number of entries. """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._entries),
+        }
+
+    def _append(self, link):
+        last = self._root[0]
+        link[0] = last
+        link[1] = self._root
+        last[1] = self._root[0] = link
+
+    def _unlink(self, link):
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+
+    def _remove(self, key):
+        link, value, expires = self._entries.pop(key)
+        self._unlink(link)
+        table_keys = self._by_table[key[0]]
+        table_keys.discard(key)
+        if not table_keys:
+            del self._by_table[key[0]]
+
+
+def _where_cache_key(where):
+    if isinstance(where, op.Or):
+        groups = tuple(_where_cache_key(group) for group in where.wheres)
+        if None in groups:
+            return None
+        return ('OR',) + groups
+    items = []
+    for key, value in sorted(where.iteritems()):
+        if isinstance(value, basestring):
+            items.append((key, value))
+        elif isinstance(value, op.RE):
+            items.append((key, 'RE', value.pattern))
+        elif isinstance(value, op.In):
+            items.append((key, 'IN', tuple(value.values)))
+        elif isinstance(value, op.Ne):
+            items.append((key, 'NE', value.value))
+        elif isinstance(value, (op._Compare, op.Range)):
+            items.append((key, 'CMP', tuple(_comparisons(value))))
+        elif isinstance(value, op.Prefix):
+            items.append((key, 'PREFIX', value.prefix))
+        elif isinstance(value, op.Exists):
+            items.append((key, 'EXISTS'))
+        else:
+            return None
+    return tuple(items)
+
+
+def _query_cache_key(name, where, order_by, offset, limit, count):
+    """ Key for caching the results of a query in a :class:`RowCache`, or
+    `None` if the query can't be cached. """
+    where_key = _where_cache_key(where)
+    if where_key is None:
+        return None
+    sort_field, reverse = _parse_order_by(order_by)
+    return (name, 'query', where_key, sort_field, reverse,
+            offset, limit, count)
+
+
+class ConnectionPool(object):
+    """ Thread-safe pool of database connections, opened by calling
+    `connect`. At most `max_size` connections are open at a time; when all
+    of them are in use, :meth:`getconn` waits up to `timeout` seconds for
+    one to be returned, then raises :class:`PoolTimeout`. `min_size`
+    connections are opened upfront and kept open even when idle.
+
+    Connections older than `max_age` seconds, or idle for longer than
+    `max_idle` seconds, are closed and replaced. `reset` is called with
+    each returned connection and should clean it up (e.g. roll back any
+    transaction) and return True, or return False if the connection is
+    broken. `validate` is called before handing out an idle connection
+    and should return False, or raise an exception, if the connection is
+    unusable.
+    """
+
+    def __init__(self, connect, min_size=0, max_size=5, timeout=30,
+                 max_age=None, max_idle=None, reset=None, validate=None):
+        self._connect = connect
+        self._reset = reset
+        self._validate = validate
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_age = max_age
+        self.max_idle = max_idle
+        self._lock = threading.Condition()
+        self._idle = []  # (conn, created, returned), most recent last
+        self._in_use = {}  # id(conn) -> created
+        self._reserved = 0  # being opened, or validated before checkout
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.discarded = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        for c in range(min_size):
+            self._idle.append((connect(), time.time(), time.time()))
+
+    def _expired(self, created, returned, now):
+        if self.max_age is not None and now - created > self.max_age:
+            return True
+        if self.max_idle is not None and now - returned > self.max_idle:
+            return len(self._idle) + len(self._in_use) > self.min_size
+        return False
+
+    def _close(self, conn):
+        self.discarded += 1
+        try:
+            conn.close()
+        except Exception:
+            log.exception("Error while closing connection")
+
+    def _reserve(self, deadline):
+        """ Reserve a slot in the pool, waiting until `deadline` if they are
+        all taken. Returns an idle ``(conn, created)`` pair, or ``(None,
+        None)`` if a new connection should be opened. """
+        with self._lock:
+            while True:
+                now = time.time()
+                while self._idle:
+                    conn, created, returned = self._idle[-1]
+                    expired = self._expired(created, returned, now)
+                    self._idle.pop()
+                    if expired:
+                        self._close(conn)
+                        continue
+                    self._reserved += 1
+                    return conn, created
+                size = len(self._in_use) + self._reserved
+                if size < self.max_size:
+                    self._reserved += 1
+                    return None, None
+                if deadline is not None and now >= deadline:
+                    self.checkout_failures += 1
+                    raise PoolTimeout("No connection available after "
+                                      "%s seconds" % self.timeout)
+                self._lock.wait(None if deadline is None else deadline - now)
+
+    def _unreserve(self):
+        with self._lock:
+            self._reserved -= 1
+            self._lock.notify()
+
+    def getconn(self):
+        """ Check out a connection. """
+        start = time.time()
+        deadline = None if self.timeout is None else start + self.timeout
+        while True:
+            conn, created = self._reserve(deadline)
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self.checkout_failures += 1
+                    self._unreserve()
+                    raise
+                created = time.time()
+            elif self._validate is not None:
+                try:
+                    valid = self._validate(conn)
+                except Exception:
+                    log.exception("Error while validating connection")
+                    valid = False
+                if not valid:
+                    with self._lock:
+                        self._close(conn)
+                    self._unreserve()
+                    continue
+            break
+        waited = time.time() - start
+        with self._lock:
+            self._reserved -= 1
+            self._in_use[id(conn)] = created
+            self.checkouts += 1
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+        return conn
+
+    def putconn(self, conn, close=False):
+        """ Return a connection to the pool. If `close` is True, or the
+        connection turns out to be broken, it's closed instead of being
+        kept for reuse. """
+        with self._lock:
+            created = self._in_use.pop(id(conn))
+        if not close and self._reset is not None:
+            try:
+                close = not self._reset(conn)
+            except Exception:
+                log.exception("Error while resetting connection")
+                close = True
+        now = time.time()
+        with self._lock:
+            if close or self._expired(created, now, now):
+                self._close(conn)
+            else:
+                self._idle.append((conn, created, now))
+            # close connections that have been idle for too long
+            for item in list(self._idle):
+                if self._expired(item[1], item[2], now):
+                    self._idle.remove(item)
+                    self._close(item[0])
+            self._lock.notify()
+
+    def closeall(self):
+        """ Close all idle connections. """
+        with self._lock:
+            while self._idle:
+                self._close(self._idle.pop()[0])
+
+    def stats(self):
+        """ Return a `dict` with the number of connections that are
+        `in_use` and `idle`, the `checkouts` and `checkout_failures`
+        counters, the number of `discarded` connections, and the total and
+        maximum time spent waiting for a connection, in seconds. """
+        with self._lock:
+            return {
+                'in_use': len(self._in_use),
+                'idle': len(self._idle),
+                'max_size': self.max_size,
+                'checkouts': self.checkouts,
+                'checkout_failures': self.checkout_failures,
+                'discarded': self.discarded,
+                'wait_time': self.wait_time,
+                'max_wait_time': self.max_wait_time,
+            }
 
 
 class PostgresqlDB(object):
@@ -142,24 +926,119 @@ class PostgresqlDB(object):
     Session pool for a PostgreSQL database. Expects a connection string,
     for example ``'postgresql://localhost/myproject'``.
     If `debug` is True, a validation is performed on `row.save()`,
-    to make sure all keys and values are strings. `schema` is deprecated.
+    to make sure all keys and values are strings. If `identity_map` is
+    True, each session remembers the rows loaded with :meth:`Table.get`
+    and returns the same object for repeated requests of the same `id`.
+    `cache` is an optional :class:`RowCache`, shared by all sessions.
+    `on_connect` is called with each new database connection, once, before
+    it's first used; it can be used to set up things like statement
+    timeouts.
+
+    The `pool_*` arguments configure the :class:`ConnectionPool`: at most
+    `pool_size` connections, waiting up to `pool_timeout` seconds for a
+    free one, recycling connections older than `pool_max_age` or idle for
+    more than `pool_max_idle` seconds. If `pool_pre_ping` is True, idle
+    connections are tested with a query before being reused.
+
+    If `prepare` is True, queries made by :meth:`Table.query` and
+    :meth:`Table.get` are sent as server-side prepared statements, once
+    per connection, so PostgreSQL parses and plans each kind of query only
+    once.
+
+    If `dedup_blobs` is True, blobs with identical contents are stored
+    only once: :meth:`DbFile.save_from` hashes the data as it's written
+    and, if the same data was already saved, keeps a reference to the
+    existing large object instead. Reference counts are kept in the
+    ``htables_blob_refs`` table, created on first use, and
+    :meth:`Session.del_db_file` only deletes a large object when its last
+    reference is gone. `schema` is deprecated.
     """
 
-    def __init__(self, connection_uri, schema=None, debug=False):
+    def __init__(self, connection_uri, schema=None, debug=False,
+                 identity_map=False, cache=None, on_connect=None,
+                 pool_size=5, pool_min_size=0, pool_timeout=30,
+                 pool_max_age=None, pool_max_idle=None,
+                 pool_pre_ping=False, prepare=False, dedup_blobs=False):
         global psycopg2
-        import psycopg2.pool
+        import psycopg2.extensions
         import psycopg2.extras
         if schema is None:
             schema = Schema([])
         self._schema = schema
         params = transform_connection_uri(connection_uri)
-        self._conn_pool = psycopg2.pool.ThreadedConnectionPool(0, 5, **params)
+        self._hstore_oids = None
+        self._on_connect = on_connect
+        self._pre_ping = pool_pre_ping
+        self._prepare = prepare
+        self._dedup_blobs = dedup_blobs
+        self._blob_refs_ready = False
+
+        def connect():
+            conn = psycopg2.connect(
+                connection_factory=_get_postgresql_connection_cls(),
+                **params)
+            self._setup_connection(conn)
+            return conn
+
+        self._conn_pool = ConnectionPool(connect, min_size=pool_min_size,
+                                         max_size=pool_size,
+                                         timeout=pool_timeout,
+                                         max_age=pool_max_age,
+                                         max_idle=pool_max_idle,
+                                         reset=self._reset_connection,
+                                         validate=self._validate_connection)
         self._debug = debug
+        self._identity_map = identity_map
+        self._cache = cache
+        self._index_cache = {}
+
+    def _setup_connection(self, conn):
+        """ Prepare a newly opened connection. The hstore type OIDs are
+        looked up in the catalog only for the first connection. """
+        if self._hstore_oids is None:
+            oids = psycopg2.extras.HstoreAdapter.get_oids(conn)
+            if oids[0]:
+                self._hstore_oids = oids
+        if self._hstore_oids is None:
+            # no hstore type; let register_hstore report the error
+            psycopg2.extras.register_hstore(conn, globally=False,
+                                            unicode=True)
+        else:
+            oid, array_oid = self._hstore_oids
+            psycopg2.extras.register_hstore(conn, globally=False,
+                                            unicode=True, oid=oid,
+                                            array_oid=array_oid)
+        if self._on_connect is not None:
+            self._on_connect(conn)
+
+    def _reset_connection(self, conn):
+        if conn.closed:
+            return False
+        status = conn.get_transaction_status()
+        if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+        return True
+
+    def _validate_connection(self, conn):
+        if conn.closed:
+            return False
+        if self._pre_ping:
+            try:
+                conn.cursor().execute("SELECT 1")
+                conn.rollback()
+            except psycopg2.Error:
+                return False
+        return True
 
     def _get_connection(self):
-        conn = self._conn_pool.getconn()
-        psycopg2.extras.register_hstore(conn, globally=False, unicode=True)
-        return conn
+        return self._conn_pool.getconn()
+
+    def pool_stats(self):
+        """ Statistics about the connection pool, as returned by
+        :meth:`ConnectionPool.stats`. """
+        return self._conn_pool.stats()
 
     def get_session(self, lazy=False):
         """ Get a :class:`Session` for talking to the database. If `lazy` is
@@ -173,6 +1052,9 @@ class PostgresqlDB(object):
         session._pool = self
         if self._debug:
             session._debug = True
+        if self._identity_map:
+            session._identity_map = {}
+        session._cache = self._cache
         return session
 
     def put_session(self, session):
@@ -197,11 +1079,21 @@ class Schema(object):
         for name in names:
             self.define_table(name, name)
 
-    def define_table(self, cls_name, table_name):
+    def define_table(self, cls_name, table_name, indexes=(), compress=None):
+        """ Declare a table. `indexes` is a list of keys to be indexed when
+        the table is created; use `None` for an index on the whole row.
+
+        With SQLite, rows of the table are compressed if `compress` is
+        ``'zlib'`` (or ``'zstd'``, if the `zstandard` package is installed).
+        Compressed rows can't be indexed or filtered in SQL, so queries on
+        the table are evaluated in Python. Uncompressed rows saved earlier
+        are still readable. """
         # TODO make sure table_name is safe
 
         class cls(TableRow):
             _table = table_name
+            _indexes = tuple(indexes)
+            _compress = compress
         cls.__name__ = cls_name
 
         self._by_name[table_name] = cls
@@ -223,8 +1115,15 @@ class PostgresqlDialect(object):
 
     _missing_table_pattern = re.compile(r'^relation "([^"]+)" does not exist')
 
-    def __init__(self, conn):
+    _key_index_pattern = re.compile(
+        r"USING btree \(+data -> '((?:[^']|'')*)'::text\)+"
+        r"(?: COLLATE \"C\"\))?$")
+
+    _data_index_pattern = re.compile(r"USING gin \(data\)$")
+
+    def __init__(self, conn, pool=None):
         self.conn = conn
+        self.pool = pool
 
     def execute(self, *args, **kwargs):
         cursor = kwargs.get('cursor') or self.conn.cursor()
@@ -242,6 +1141,41 @@ class PostgresqlDialect(object):
             raise
         return cursor
 
+    # prepared statements kept on each connection
+    _max_statements = 200
+
+    _placeholder_pattern = re.compile(r'%[s%]')
+
+    def _query(self, sql_query, params, cursor=None):
+        """ Execute a query that was built with `%` escaped as `%%`. If
+        enabled, it's run as a prepared statement, which is created the
+        first time the query is seen on this connection. """
+        if not params:
+            return self.execute(sql_query.replace('%%', '%'), cursor=cursor)
+        statements = getattr(self.conn, '_htables_statements', False)
+        if (cursor is not None or statements is False or
+                self.pool is None or not self.pool._prepare):
+            return self.execute(sql_query, params, cursor=cursor)
+        if statements is None:
+            statements = self.conn._htables_statements = {}
+        name = statements.get(sql_query)
+        if name is None:
+            if len(statements) >= self._max_statements:
+                return self.execute(sql_query, params)
+            numbers = itertools.count(1)
+
+            def placeholder(m):
+                if m.group() == '%%':
+                    return '%'
+                return '$%d' % numbers.next()
+
+            name = 'htables_%d' % (len(statements) + 1)
+            self.execute("PREPARE %s AS %s" % (
+                name, self._placeholder_pattern.sub(placeholder, sql_query)))
+            statements[sql_query] = name
+        return self.execute("EXECUTE %s (%s)" %
+                            (name, ', '.join(['%s'] * len(params))), params)
+
     def create_table(self, name):
         self.execute("CREATE TABLE IF NOT EXISTS " + name + " ("
                      "id SERIAL PRIMARY KEY, "
@@ -249,66 +1183,264 @@ class PostgresqlDialect(object):
 
     def drop_table(self, name):
         self.execute("DROP TABLE IF EXISTS " + name)
+        self._forget_indexes(name)
+
+    def create_index(self, name, key, unique=False):
+        if key is None:
+            self.execute("CREATE INDEX IF NOT EXISTS " + name + "_gin_idx"
+                         " ON " + name + " USING gin (data)")
+        else:
+            self.execute("CREATE " + ("UNIQUE " if unique else "") +
+                         "INDEX IF NOT EXISTS " +
+                         _index_name(name, key) + " ON " + name +
+                         " ((data -> " + _postgresql_quote(key) + ")"
+                         " COLLATE \"C\")")
+        self._forget_indexes(name)
+
+    def drop_index(self, name, key):
+        if key is None:
+            self.execute("DROP INDEX IF EXISTS " + name + "_gin_idx")
+        else:
+            self.execute("DROP INDEX IF EXISTS " + _index_name(name, key))
+        self._forget_indexes(name)
+
+    def list_indexes(self, name):
+        cursor = self.execute("SELECT indexdef FROM pg_indexes "
+                              "WHERE tablename = %s", (name,))
+        indexes = []
+        for (indexdef,) in cursor:
+            if self._data_index_pattern.search(indexdef) is not None:
+                indexes.append(None)
+                continue
+            m = self._key_index_pattern.search(indexdef)
+            if m is not None:
+                indexes.append(m.group(1).replace("''", "'"))
+        return indexes
+
+    def _cached_indexes(self, name):
+        """ Indexes of table `name`, as returned by :meth:`list_indexes`.
+        The result is cached on the connection pool, so the catalog is
+        queried only once per table. """
+        if self.pool is None:
+            return self.list_indexes(name)
+        try:
+            return self.pool._index_cache[name]
+        except KeyError:
+            indexes = self.pool._index_cache[name] = self.list_indexes(name)
+            return indexes
+
+    def _forget_indexes(self, name):
+        if self.pool is not None:
+            self.pool._index_cache.pop(name, None)
 
     def insert(self, name, obj):
         cursor = self.execute("INSERT INTO " + name +
-                              " (data) VALUES (%s)",
+                              " (data) VALUES (%s) RETURNING id",
                               (obj,))
-        self.execute("SELECT CURRVAL(%s)", (name + '_id_seq',),
-                     cursor=cursor)
-        [(last_insert_id,)] = list(cursor)
+        [last_insert_id] = cursor.fetchone()
         return last_insert_id
 
+    def insert_many(self, name, objs):
+        cursor = self.execute("INSERT INTO " + name + " (data) VALUES " +
+                              ", ".join(["(%s)"] * len(objs)) +
+                              " RETURNING id",
+                              objs)
+        return [row[0] for row in cursor]
+
     def select_by_id(self, name, obj_id):
-        cursor = self.execute("SELECT data FROM " + name +
-                              " WHERE id = %s",
-                              (obj_id,))
+        cursor = self._query("SELECT data FROM " + name +
+                             " WHERE id = %s",
+                             (obj_id,))
         return list(cursor)
 
-    def select(self, name, where, order_by, offset, limit, count):
+    def select_by_ids(self, name, obj_ids):
+        return list(self._query("SELECT id, data FROM " + name +
+                                " WHERE id = ANY(%s)",
+                                (list(obj_ids),)))
+
+    def _compile_where(self, name, where):
+        """ Translate `where` into a list of SQL conditions, with `%s`
+        placeholders for the values, and a list of parameters. Keys are
+        sorted, so the SQL is the same for all queries of the same shape.
+        If the table has an index on the whole row, equality tests on keys
+        without their own index are merged into one `@>` containment test,
+        which can use the GIN index. """
+        if isinstance(where, op.Or):
+            groups = []
+            params = []
+            for group in where.wheres:
+                group_conditions, group_params = self._compile_where(name,
+                                                                     group)
+                groups.append("(%s)" % (' AND '.join(group_conditions) or
+                                        "TRUE"))
+                params += group_params
+            return ["(%s)" % (' OR '.join(groups) or "FALSE")], params
+
+        conditions = []
+        params = []
+        contained = []
+        indexes = None
+        for key in sorted(where):
+            value = where[key]
+            if isinstance(value, basestring):
+                if indexes is None:
+                    indexes = self._cached_indexes(name)
+                if None in indexes and key not in indexes:
+                    contained.append((key, value))
+                    continue
+                conditions.append(_postgresql_key(key) + " = %s")
+                params.append(value)
+            elif isinstance(value, op.RE):
+                conditions.append(_postgresql_key(key) + " ~ %s")
+                params.append(value.pattern)
+            elif isinstance(value, op.SQL):
+                conditions.append(value.postgresql(key).replace('%', '%%'))
+            elif isinstance(value, op.In):
+                conditions.append(_postgresql_key(key) + " = ANY(%s::text[])")
+                params.append(value.values)
+            elif isinstance(value, op.Ne):
+                conditions.append(_postgresql_key(key) +
+                                  " IS DISTINCT FROM %s")
+                params.append(value.value)
+            elif isinstance(value, (op._Compare, op.Range)):
+                for sql_operator, bound in _comparisons(value):
+                    conditions.append("%s %s %%s" % (_postgresql_key(key),
+                                                     sql_operator))
+                    params.append(bound)
+            elif isinstance(value, op.Prefix):
+                # a range of strings, like on SQLite, which can use an index
+                conditions.append(_postgresql_key(key) + " >= %s")
+                params.append(value.prefix)
+                end = _prefix_end(value.prefix)
+                if end is None:
+                    # backslash is the default LIKE escape character
+                    conditions.append(_postgresql_key(key) + " LIKE %s")
+                    params.append(re.sub(r'([\\%_])', r'\\\1',
+                                         value.prefix) + '%')
+                else:
+                    conditions.append(_postgresql_key(key) + " < %s")
+                    params.append(end)
+            elif isinstance(value, op.Exists):
+                conditions.append("data ? %s")
+                params.append(key)
+            else:
+                raise RuntimeError("Unknown operator %r" % value)
+        if contained:
+            conditions.append("data @> hstore(ARRAY[%s], %%s)" %
+                              ', '.join(_postgresql_quote(k).replace('%', '%%')
+                                        for k, v in contained))
+            params.append([v for k, v in contained])
+        return conditions, params
+
+    def select(self, name, where, order_by, offset, limit, count,
+               fetch_size=None, after=None, fields=None):
+        conditions = []
+        params = []
         if count:
             sql_query = "SELECT COUNT(*)"
+        elif fields is not None:
+            sql_query = "SELECT id, slice(data, %s::text[])"
+            params.append(list(fields))
         else:
             sql_query = "SELECT id, data"
         sql_query += " FROM " + name
         if where:
-            conditions = []
-            for key, value in where.iteritems():
-                if isinstance(value, basestring):
-                    conditions.append("data -> %s = %s" %
-                                      (_postgresql_quote(key),
-                                       _postgresql_quote(value)))
-                elif isinstance(value, op.RE):
-                    conditions.append("data -> %s ~ %s" %
-                                      (_postgresql_quote(key),
-                                       _postgresql_quote(value.pattern)))
-                elif isinstance(value, op.SQL):
-                    conditions.append(value.postgresql(key))
-                else:
-                    raise RuntimeError("Unknown operator %r" % value)
+            where_conditions, where_params = self._compile_where(name, where)
+            conditions += where_conditions
+            params += where_params
+        sort_field, reverse = _parse_order_by(order_by)
+        if sort_field is not None:
+            sort_expr = _postgresql_key(sort_field)
+        if after is not None:
+            def literal(value):
+                params.append(value)
+                return '%s'
+            # PostgreSQL sorts NULL values after everything else
+            conditions.append(_keyset_condition(
+                sort_expr if sort_field is not None else None,
+                after, reverse, reverse, literal))
+        if conditions:
             sql_query += " WHERE (%s)" % ' AND '.join(conditions)
-        if order_by is not None:
-            reverse = False
-            if isinstance(order_by, basestring):
-                sort_key = _postgresql_quote(order_by)
-            elif isinstance(order_by, op.Reversed):
-                sort_key = _postgresql_quote(order_by.field)
-                reverse = True
-            else:
-                raise RuntimeError("Unknown operator %r" % order_by)
-            sql_query += " ORDER BY (data -> %s)" % sort_key
+        if sort_field is not None:
+            sql_query += " ORDER BY " + sort_expr
             if reverse:
                 sql_query += " DESC"
+            sql_query += ", id"
+        elif after is not None:
+            sql_query += " ORDER BY id"
         if offset != 0:
-            sql_query += " OFFSET %d" % offset
+            sql_query += " OFFSET %s"
+            params.append(offset)
         if limit is not None:
-            sql_query += " LIMIT %d" % limit
-        return self.execute(sql_query)
+            sql_query += " LIMIT %s"
+            params.append(limit)
+        if fetch_size and not count:
+            # named cursors are server-side; rows are fetched in batches
+            cursor = self.conn.cursor('htables_%d' % _cursor_names.next())
+            cursor.itersize = fetch_size
+            return self._query(sql_query, params, cursor=cursor)
+        return self._query(sql_query, params)
 
     def update(self, name, obj_id, obj):
         self.execute("UPDATE " + name + " SET data = %s WHERE id = %s",
                      (obj, obj_id))
 
+    def _patch_expr(self, changed, removed):
+        expr = "data"
+        params = []
+        if removed:
+            expr = "delete(data, %s::text[])"
+            params.append(list(removed))
+        if changed:
+            expr += " || %s"
+            params.append(changed)
+        return expr, params
+
+    def update_keys(self, name, obj_id, changed, removed):
+        expr, params = self._patch_expr(changed, removed)
+        self.execute("UPDATE " + name + " SET data = " + expr +
+                     " WHERE id = %s", params + [obj_id])
+
+    def update_where(self, name, where, changed, removed):
+        expr, params = self._patch_expr(changed, removed)
+        sql_query = "UPDATE " + name + " SET data = " + expr
+        if where:
+            conditions, where_params = self._compile_where(name, where)
+            sql_query += " WHERE (%s)" % ' AND '.join(conditions)
+            params += where_params
+        return self.execute(sql_query, params).rowcount
+
+    def upsert(self, name, match, data):
+        # the conflict target must match a unique index, and those can
+        # only be created on a single key
+        if len(match) != 1:
+            raise ValueError("PostgreSQL upsert needs exactly one key "
+                             "to match, with a unique index")
+        [key] = match
+        # the index collation doesn't have to be named to be inferred
+        target = "(data -> %s)" % _postgresql_quote(key).replace('%', '%%')
+        values = dict(match)
+        values.update(data)
+        cursor = self.execute("INSERT INTO " + name + " AS t (data) "
+                              "VALUES (%s) ON CONFLICT (" + target + ") "
+                              "DO UPDATE SET data = t.data || EXCLUDED.data "
+                              "RETURNING id, (xmax = 0)", (values,))
+        [obj_id, created] = cursor.fetchone()
+        return obj_id, created
+
+    def delete_where(self, name, where):
+        sql_query = "DELETE FROM " + name
+        params = []
+        if where:
+            conditions, params = self._compile_where(name, where)
+            sql_query += " WHERE (%s)" % ' AND '.join(conditions)
+        return self.execute(sql_query, params).rowcount
+
+    def reencode(self, name, batch_size=1000):
+        """ Intentionally does nothing: rows are always stored as hstore,
+        which has no codec or compression options, so there is nothing to
+        rewrite. """
+
     def delete(self, name, obj_id):
         self.execute("DELETE FROM " + name + " WHERE id = %s", (obj_id,))
 
@@ -317,8 +1449,12 @@ class SqliteDialect(object):
 
     _missing_table_pattern = re.compile(r'^no such table: (.+)')
 
-    def __init__(self, conn):
+    _key_index_pattern = re.compile(
+        r"\(json_extract\(data, '\$\.\"((?:[^']|'')*)\"'\)\)$")
+
+    def __init__(self, conn, pool=None):
         self.conn = conn
+        self.pool = pool
 
     def execute(self, *args):
         cursor = self.conn.cursor()
@@ -343,14 +1479,124 @@ class SqliteDialect(object):
 
     def drop_table(self, name):
         self.execute("DROP TABLE IF EXISTS " + name)
+        self._forget_binary_rows(name)
+
+    def create_index(self, name, key, unique=False):
+        if key is None:
+            raise ValueError("SQLite can't index whole rows")
+        path = self._json_path(key, name)
+        if path is None:
+            raise ValueError("Can't create index on key %r" % key)
+        self.execute("CREATE " + ("UNIQUE " if unique else "") +
+                     "INDEX IF NOT EXISTS " + _index_name(name, key) +
+                     " ON " + name + " (json_extract(data, " + path + "))")
+
+    def drop_index(self, name, key):
+        if key is None:
+            raise ValueError("SQLite can't index whole rows")
+        self.execute("DROP INDEX IF EXISTS " + _index_name(name, key))
+
+    def list_indexes(self, name):
+        cursor = self.execute("SELECT sql FROM sqlite_master "
+                              "WHERE type = 'index' AND tbl_name = ?",
+                              (name,))
+        indexes = []
+        for (sql,) in cursor:
+            m = self._key_index_pattern.search(sql or '')
+            if m is not None:
+                indexes.append(m.group(1).replace("''", "'"))
+        return indexes
 
     def select_by_id(self, name, obj_id):
         cursor = self.execute("SELECT data FROM " + name +
                                " WHERE id = ?",
                                (obj_id,))
-        return [(json.loads(r[0]),) for r in cursor]
+        return [(self._load(r[0]),) for r in cursor]
+
+    def select_by_ids(self, name, obj_ids):
+        obj_ids = list(obj_ids)
+        results = []
+        for start in range(0, len(obj_ids), self._max_variables):
+            batch = obj_ids[start:start + self._max_variables]
+            cursor = self.execute("SELECT id, data FROM " + name +
+                                  " WHERE id IN (" +
+                                  ", ".join(["?"] * len(batch)) + ")",
+                                  batch)
+            results.extend((id, self._load(data)) for id, data in cursor)
+        return results
 
-    def _clip_results(self, cursor, where):
+    @property
+    def _codec(self):
+        return 'json' if self.pool is None else self.pool._codec
+
+    def _compression(self, name):
+        """ Compression configured in the schema for table `name`. """
+        if self.pool is None:
+            return None
+        try:
+            return self.pool.schema[name]._compress
+        except KeyError:
+            return None
+
+    def _dump(self, name, obj):
+        fmt, dumps, loads = _row_formats[self._codec]
+        data = dumps(obj)
+        compress = self._compression(name)
+        if compress is None:
+            if fmt == 'j':
+                return data  # plain JSON text, readable by JSON1
+        else:
+            compressor = _compressor(compress)
+            data = compressor.compress(data) + compressor.flush()
+        return buffer(COMPRESSION_HEADER + fmt + _compression_tags[compress] +
+                      data)
+
+    def _load(self, value):
+        if isinstance(value, buffer):
+            value = str(value)
+        if not value.startswith(COMPRESSION_HEADER):
+            return json.loads(value)
+        offset = len(COMPRESSION_HEADER) + 2
+        fmt, tag = value[offset - 2:offset]
+        decompressor = _decompressor(tag)
+        value = value[offset:]
+        if decompressor is not None:
+            value = decompressor.decompress(value) + decompressor.flush()
+        return _row_loads[fmt](value)
+
+    def _has_binary_rows(self, name):
+        """ Check if table `name` holds rows that aren't JSON text, written
+        with compression or another codec before the configuration changed.
+        JSON1 functions fail on those, so the table must be queried in
+        Python until :meth:`reencode` runs. The answer is cached on the
+        pool. """
+        binary_rows = None if self.pool is None else self.pool._binary_rows
+        if binary_rows is not None and name in binary_rows:
+            return binary_rows[name]
+        cursor = self.execute("SELECT 1 FROM " + name +
+                              " WHERE typeof(data) != 'text' LIMIT 1")
+        found = cursor.fetchone() is not None
+        if binary_rows is not None:
+            binary_rows[name] = found
+        return found
+
+    def _forget_binary_rows(self, name):
+        if self.pool is not None:
+            self.pool._binary_rows.pop(name, None)
+
+    def _json_path(self, key, name):
+        """ SQL literal of the JSON1 path that extracts `key` from the
+        `data` column of table `name`, or `None` if the lookup can't be
+        done in SQL. """
+        if '"' in key or not _sqlite_has_json1():
+            return None
+        if self._codec != 'json' or self._compression(name) is not None:
+            return None
+        if self._has_binary_rows(name):
+            return None
+        return "'$.\"%s\"'" % key.replace("'", "''")
+
+    def _matcher(self, key, value):
         def eq_matcher(key, value):
             return lambda data: data.get(key) == value
 
@@ -358,34 +1604,228 @@ class SqliteDialect(object):
             compiled = re.compile(value.pattern)
             return lambda data: compiled.search(data.get(key, '')) is not None
 
+        def compare_matcher(key, comparisons):
+            comparisons = [(_python_operators[sql_operator], bound)
+                           for sql_operator, bound in comparisons]
+            return lambda data: key in data and all(
+                compare(data[key], bound) for compare, bound in comparisons)
+
+        def prefix_matcher(key, prefix):
+            return lambda data: (isinstance(data.get(key), basestring) and
+                                 data[key].startswith(prefix))
+
+        if isinstance(value, basestring):
+            return eq_matcher(key, value)
+        elif isinstance(value, op.RE):
+            return re_matcher(key, value)
+        elif isinstance(value, op.SQL):
+            return value.sqlite(key)
+        elif isinstance(value, op.In):
+            values = value.values
+            return lambda data: key in data and data[key] in values
+        elif isinstance(value, op.Ne):
+            return lambda data: data.get(key) != value.value
+        elif isinstance(value, (op._Compare, op.Range)):
+            return compare_matcher(key, _comparisons(value))
+        elif isinstance(value, op.Prefix):
+            return prefix_matcher(key, value.prefix)
+        elif isinstance(value, op.Exists):
+            return lambda data: key in data
+        else:
+            raise RuntimeError("Unknown operator %r" % value)
+
+    def _where_matcher(self, where):
+        """ Python matcher for the whole of `where`. """
+        if isinstance(where, op.Or):
+            groups = [self._where_matcher(group) for group in where.wheres]
+            return lambda data: any(group(data) for group in groups)
+        matchers = [self._matcher(key, value)
+                    for key, value in where.iteritems()]
+        return lambda data: all(m(data) for m in matchers)
+
+    def _compile_where(self, name, where):
+        """ Translate `where` into SQL conditions and their parameters.
+        Operators that can't be expressed in SQL are returned as Python
+        matchers, to be applied on the decoded rows. """
+        if isinstance(where, op.Or):
+            groups = []
+            params = []
+            for group in where.wheres:
+                group_conditions, group_params, group_matchers = \
+                    self._compile_where(name, group)
+                if group_matchers:
+                    return [], [], [self._where_matcher(where)]
+                groups.append("(%s)" % (' AND '.join(group_conditions) or "1"))
+                params += group_params
+            return ["(%s)" % (' OR '.join(groups) or "0")], params, []
+
+        conditions = []
+        params = []
         matchers = []
         for key, value in where.iteritems():
-            if isinstance(value, basestring):
-                matchers.append(eq_matcher(key, value))
+            path = self._json_path(key, name)
+            expr = "json_extract(data, %s)" % path
+            if path is None or isinstance(value, op.SQL):
+                matchers.append(self._matcher(key, value))
+            elif isinstance(value, basestring):
+                conditions.append(expr + " = ?")
+                params.append(value)
             elif isinstance(value, op.RE):
-                matchers.append(re_matcher(key, value))
-            elif isinstance(value, op.SQL):
-                matchers.append(value.sqlite(key))
+                conditions.append(expr + " REGEXP ?")
+                params.append(value.pattern)
+            elif isinstance(value, op.In):
+                if len(value.values) > self._max_variables:
+                    matchers.append(self._matcher(key, value))
+                    continue
+                conditions.append("%s IN (%s)" % (
+                    expr, ", ".join(["?"] * len(value.values))))
+                params.extend(value.values)
+            elif isinstance(value, op.Ne):
+                conditions.append(expr + " IS NOT ?")
+                params.append(value.value)
+            elif isinstance(value, (op._Compare, op.Range)):
+                for sql_operator, bound in _comparisons(value):
+                    conditions.append("%s %s ?" % (expr, sql_operator))
+                    params.append(bound)
+            elif isinstance(value, op.Prefix):
+                # a range of strings, which can use an index, unlike LIKE
+                conditions.append(expr + " >= ?")
+                params.append(value.prefix)
+                end = _prefix_end(value.prefix)
+                if end is None:
+                    matchers.append(self._matcher(key, value))
+                else:
+                    conditions.append(expr + " < ?")
+                    params.append(end)
+            elif isinstance(value, op.Exists):
+                conditions.append("json_type(data, %s) IS NOT NULL" % path)
             else:
                 raise RuntimeError("Unknown operator %r" % value)
+        return conditions, params, matchers
 
+    def _clip_results(self, cursor, matchers):
         for (id, data_json) in cursor:
-            data = json.loads(data_json)
+            data = self._load(data_json)
             if all(m(data) for m in matchers):
                 yield (id, data)
 
-    def select(self, name, where, order_by, offset, limit, count):
-        cursor = self.execute("SELECT id, data FROM " + name)
-        results = self._clip_results(cursor, where)
-        if order_by:
-            reverse = False
-            if isinstance(order_by, basestring):
-                sort_key = lambda r: r[1].get(order_by)
-            elif isinstance(order_by, op.Reversed):
-                sort_key = lambda r: r[1].get(order_by.field)
-                reverse = True
+    def _projection(self, name, fields):
+        """ SQL columns that select the values of `fields`, and a function
+        that turns them into a `dict`; or `None` if that can't be done in
+        SQL. """
+        paths = [self._json_path(key, name) for key in fields]
+        if not fields or None in paths:
+            return None
+        columns = ", ".join("json_type(data, %s), json_extract(data, %s)" %
+                            (path, path) for path in paths)
+
+        def make_row(values):
+            data = {}
+            for i, key in enumerate(fields):
+                json_type = values[2 * i]
+                if json_type is None:
+                    continue  # key is missing
+                value = values[2 * i + 1]
+                if json_type in ('array', 'object'):
+                    value = json.loads(value)
+                elif json_type in ('true', 'false'):
+                    value = bool(value)
+                data[key] = value
+            return data
+
+        return columns, make_row
+
+    def _after_matcher(self, sort_field, after, reverse):
+        value, obj_id = after
+
+        def matcher(row):
+            row_value = row[1].get(sort_field)
+            if row_value == value:
+                return row[0] > obj_id
+            elif reverse:
+                return row_value < value
+            else:
+                return row_value > value
+
+        return matcher
+
+    def select(self, name, where, order_by, offset, limit, count,
+               fetch_size=None, after=None, fields=None):
+        conditions, params, matchers = self._compile_where(name, where)
+        sort_field, reverse = _parse_order_by(order_by)
+        if sort_field is None:
+            sort_path = None
+            sql_order = " ORDER BY id"
+        else:
+            sort_path = self._json_path(sort_field, name)
+            if sort_path is None:
+                sql_order = " ORDER BY id"
             else:
-                raise RuntimeError("Unknown operator %r" % order_by)
+                sort_expr = "json_extract(data, %s)" % sort_path
+                sql_order = " ORDER BY %s%s, id" % (
+                    sort_expr, " DESC" if reverse else "")
+
+        after_matcher = None
+        if after is not None:
+            if sort_field is None or sort_path is not None:
+                def literal(value):
+                    if isinstance(value, (list, dict)):
+                        # json_extract returns arrays and objects as text
+                        value = json.dumps(value, separators=(',', ':'))
+                    params.append(value)
+                    return '?'
+                # SQLite sorts NULL values before everything else
+                conditions.append(_keyset_condition(
+                    sort_expr if sort_path is not None else None,
+                    after, reverse, not reverse, literal))
+            else:
+                after_matcher = self._after_matcher(sort_field, after,
+                                                    reverse)
+
+        sql_query = " FROM " + name
+        if conditions:
+            sql_query += " WHERE " + " AND ".join(conditions)
+
+        if not matchers and (sort_field is None or sort_path is not None):
+            sql_clip = ""
+            if offset or limit is not None:
+                sql_clip = " LIMIT ? OFFSET ?"
+                params += [-1 if limit is None else limit, offset]
+            if count:
+                if sql_clip:
+                    sql_query = (" FROM (SELECT id" + sql_query + sql_order +
+                                 sql_clip + ")")
+                return self.execute("SELECT COUNT(*)" + sql_query, params)
+            projection = None
+            if fields is not None:
+                projection = self._projection(name, fields)
+            if projection is not None:
+                columns, make_row = projection
+                cursor = self.execute("SELECT id, " + columns + sql_query +
+                                      sql_order + sql_clip, params)
+                if fetch_size:
+                    cursor = _iter_cursor(cursor, fetch_size)
+                return ((r[0], make_row(r[1:])) for r in cursor)
+            cursor = self.execute("SELECT id, data" + sql_query + sql_order +
+                                  sql_clip, params)
+            if fetch_size:
+                cursor = _iter_cursor(cursor, fetch_size)
+            results = ((id, self._load(data_json))
+                       for id, data_json in cursor)
+            if fields is not None:
+                results = self._project(results, fields)
+            return results
+
+        # some of the work can't be done in SQL; finish it in Python
+        cursor = self.execute("SELECT id, data" + sql_query + sql_order,
+                              params)
+        if fetch_size:
+            cursor = _iter_cursor(cursor, fetch_size)
+        results = self._clip_results(cursor, matchers)
+        if after_matcher is not None:
+            results = (row for row in results if after_matcher(row))
+        if sort_field is not None and sort_path is None:
+            sort_key = lambda r: r[1].get(sort_field)
             results = sorted(list(results), key=sort_key, reverse=reverse)
         if offset or limit:
             end = None if limit is None else offset + limit
@@ -393,17 +1833,149 @@ class SqliteDialect(object):
         if count:
             num_rows = len(list(results))
             results = [(num_rows,)]
+        elif fields is not None:
+            results = self._project(results, fields)
         return iter(results)
 
+    def _project(self, results, fields):
+        for id, data in results:
+            yield id, dict((key, data[key]) for key in fields if key in data)
+
     def insert(self, name, obj):
         cursor = self.execute("INSERT INTO " + name +
                               " (data) VALUES (?)",
-                              (json.dumps(obj),))
+                              (self._dump(name, obj),))
         return cursor.lastrowid
 
+    # stay below SQLITE_MAX_VARIABLE_NUMBER, which defaults to 999
+    _max_variables = 500
+
+    def insert_many(self, name, objs):
+        ids = []
+        for start in range(0, len(objs), self._max_variables):
+            batch = objs[start:start + self._max_variables]
+            cursor = self.execute("INSERT INTO " + name + " (data) VALUES " +
+                                  ", ".join(["(?)"] * len(batch)),
+                                  [self._dump(name, obj) for obj in batch])
+            # rows inserted by one statement get consecutive ids
+            last_insert_id = cursor.lastrowid
+            ids.extend(range(last_insert_id - len(batch) + 1,
+                             last_insert_id + 1))
+        return ids
+
     def update(self, name, obj_id, obj):
         self.execute("UPDATE " + name + " SET data = ? WHERE id = ?",
-                     (json.dumps(obj), obj_id))
+                     (self._dump(name, obj), obj_id))
+
+    def _patch_expr(self, name, changed, removed):
+        """ SQL expression, and its parameters, that applies the changes
+        to the `data` column; or `None` if it can't be done in SQL. """
+        paths = dict((key, self._json_path(key, name))
+                     for key in itertools.chain(changed, removed))
+        if (None in paths.values() or
+                len(changed) + 1 > self._max_variables):
+            return None
+        expr = "data"
+        params = []
+        if changed:
+            assignments = []
+            for key, value in changed.iteritems():
+                assignments.append("%s, json(?)" % paths[key])
+                params.append(json.dumps(value))
+            expr = "json_set(%s, %s)" % (expr, ", ".join(assignments))
+        if removed:
+            expr = "json_remove(%s, %s)" % (
+                expr, ", ".join(paths[key] for key in removed))
+        return expr, params
+
+    def _patch_rows(self, name, rows, changed, removed):
+        """ Apply the changes to decoded `rows` and write them back. """
+        updates = []
+        for id, data in rows:
+            data.update(changed)
+            for key in removed:
+                data.pop(key, None)
+            updates.append((self._dump(name, data), id))
+        self.conn.executemany("UPDATE " + name + " SET data = ? "
+                              "WHERE id = ?", updates)
+        return len(updates)
+
+    def update_keys(self, name, obj_id, changed, removed):
+        patch = self._patch_expr(name, changed, removed)
+        if patch is None:
+            # patch the row in Python, within the current transaction
+            rows = [(obj_id, data) for (data,)
+                    in self.select_by_id(name, obj_id)]
+            self._patch_rows(name, rows, changed, removed)
+            return
+        expr, params = patch
+        self.execute("UPDATE " + name + " SET data = " + expr +
+                     " WHERE id = ?", params + [obj_id])
+
+    def _select_ids(self, name, where):
+        return [id for id, data in
+                self.select(name, where, None, 0, None, False)]
+
+    def update_where(self, name, where, changed, removed):
+        conditions, params, matchers = self._compile_where(name, where)
+        patch = self._patch_expr(name, changed, removed)
+        if patch is None:
+            rows = list(self.select(name, where, None, 0, None, False))
+            return self._patch_rows(name, rows, changed, removed)
+        expr, expr_params = patch
+        sql_query = "UPDATE " + name + " SET data = " + expr
+        if matchers:
+            ids = self._select_ids(name, where)
+            self.conn.executemany(sql_query + " WHERE id = ?",
+                                  [expr_params + [id] for id in ids])
+            return len(ids)
+        if conditions:
+            sql_query += " WHERE " + " AND ".join(conditions)
+        return self.execute(sql_query, expr_params + params).rowcount
+
+    def upsert(self, name, match, data):
+        # a SELECT doesn't start a transaction, so first make a write that
+        # changes nothing: sqlite3 opens a transaction for it and SQLite
+        # takes the database write lock, so no other connection can insert
+        # a matching row between the lookup and the insert
+        self.execute("UPDATE " + name + " SET id = id WHERE 0")
+        ids = [id for id, row in self.select(name, match, None, 0, 2, False)]
+        if len(ids) > 1:
+            raise MultipleRowsFound("More than one row found")
+        if ids:
+            if data:
+                self.update_keys(name, ids[0], data, [])
+            return ids[0], False
+        values = dict(match)
+        values.update(data)
+        return self.insert(name, values), True
+
+    def delete_where(self, name, where):
+        conditions, params, matchers = self._compile_where(name, where)
+        if matchers:
+            ids = self._select_ids(name, where)
+            self.conn.executemany("DELETE FROM " + name + " WHERE id = ?",
+                                  [(id,) for id in ids])
+            return len(ids)
+        sql_query = "DELETE FROM " + name
+        if conditions:
+            sql_query += " WHERE " + " AND ".join(conditions)
+        return self.execute(sql_query, params).rowcount
+
+    def reencode(self, name, batch_size=1000):
+        last_id = 0
+        while True:
+            rows = self.execute("SELECT id, data FROM " + name +
+                                " WHERE id > ? ORDER BY id LIMIT ?",
+                                (last_id, batch_size)).fetchall()
+            if not rows:
+                break
+            self.conn.executemany("UPDATE " + name + " SET data = ? "
+                                  "WHERE id = ?",
+                                  [(self._dump(name, self._load(data)), id)
+                                   for id, data in rows])
+            last_id = rows[-1][0]
+        self._forget_binary_rows(name)
 
     def delete(self, name, obj_id):
         self.execute("DELETE FROM " + name + " WHERE id = ?", (obj_id,))
@@ -427,17 +1999,51 @@ class Table(object):
         return self._session.sql
 
     def create_table(self):
-        """ Create the backend SQL table. """
-        return self.sql.create_table(self._name)
+        """ Create the backend SQL table, along with the indexes declared
+        in the schema. """
+        self.sql.create_table(self._name)
+        for key in self._row_cls._indexes:
+            self.create_index(key)
 
     def drop_table(self):
         """ Drop the backend SQL table. """
+        self._session._clear_identity_map()
+        self._session._wrote(self._name)
         return self.sql.drop_table(self._name)
 
+    def create_index(self, key=None, unique=False):
+        """ Create an index on the values of `key`, speeding up queries that
+        filter or sort on it. If `key` is `None`, the index covers the whole
+        row (a GIN index on PostgreSQL; not supported by SQLite). If
+        `unique` is True, no two rows may have the same value for `key`;
+        rows without the key are allowed. """
+        if unique and key is None:
+            raise ValueError("Only indexes on a key can be unique")
+        return self.sql.create_index(self._name, key, unique)
+
+    def drop_index(self, key=None):
+        """ Drop the index created by :meth:`create_index`. """
+        return self.sql.drop_index(self._name, key)
+
+    def list_indexes(self):
+        """ Return the keys that are indexed. An index on the whole row is
+        listed as `None`. """
+        return self.sql.list_indexes(self._name)
+
+    def reencode(self, batch_size=1000):
+        """ Rewrite all rows in the storage format currently configured,
+        e.g. after changing the `codec` of a :class:`SqliteDB` or the
+        `compress` option of the table. Rows are readable in any format,
+        so this can be done at any time, `batch_size` rows at a time; until
+        then, SQLite filters and updates the table in Python. """
+        return self.sql.reencode(self._name, batch_size)
+
     def _row(self, id=None, data={}):
         ob = self._row_cls(data)
         ob.id = id
         ob._parent_table = self
+        if id is not None:
+            ob._saved = dict(ob)
         return ob
 
     def new(self, *args, **kwargs):
@@ -448,29 +2054,168 @@ class Table(object):
         row.save()
         return row
 
-    def save(self, obj, _deprecation_warning=True):
-        if _deprecation_warning:
-            msg = "Table.save(row) is deprecated; use row.save() instead."
-            warnings.warn(msg, DeprecationWarning, stacklevel=2)
+    def _check_data(self, obj):
         if self._session._debug:
             for key, value in obj.iteritems():
                 assert isinstance(key, basestring), \
                     "Key %r is not a string" % key
                 assert isinstance(value, basestring), \
                     "Value %r for key %r is not a string" % (value, key)
+
+    def insert_many(self, rows, batch_size=1000):
+        """ Insert each mapping from the `rows` iterable as a new row, and
+        return the list of generated ids. Rows are sent in batches of
+        `batch_size`, with one `INSERT` query per batch. """
+        ids = []
+        batch = []
+        for data in rows:
+            self._check_data(data)
+            batch.append(dict(data))
+            if len(batch) >= batch_size:
+                ids.extend(self.sql.insert_many(self._name, batch))
+                batch = []
+        if batch:
+            ids.extend(self.sql.insert_many(self._name, batch))
+        self._session._wrote(self._name)
+        return ids
+
+    def save(self, obj, _deprecation_warning=True):
+        if _deprecation_warning:
+            msg = "Table.save(row) is deprecated; use row.save() instead."
+            warnings.warn(msg, DeprecationWarning, stacklevel=2)
+        self._check_data(obj)
         if obj.id is None:
             obj.id = self.sql.insert(self._name, obj)
-        else:
+        elif obj._saved is None:
             self.sql.update(self._name, obj.id, obj)
+            self._forget(obj.id)
+        else:
+            changed, removed = obj._changes()
+            if not (changed or removed):
+                return
+            self.sql.update_keys(self._name, obj.id, changed, removed)
+            self._forget(obj.id)
+        self._session._wrote(self._name, obj.id)
+        obj._saved = dict(obj)
 
     def get(self, obj_id):
         """ Fetches the :class:`TableRow` with the given `id`. """
 
-        rows = self.sql.select_by_id(self._name, obj_id)
-        if len(rows) == 0:
-            raise RowNotFound("No %r with id=%d" % (self._row_cls, obj_id))
-        [(data,)] = rows
-        return self._row(obj_id, data)
+        identity_map = self._session._identity_map
+        if identity_map is not None:
+            try:
+                return identity_map[self._name, obj_id]
+            except KeyError:
+                pass
+        cache = self._session._cache_for(self._name)
+        data = None
+        if cache is not None:
+            data = cache.get((self._name, 'row', obj_id))
+        if data is None:
+            if cache is not None:
+                generation = cache.generation(self._name)
+            rows = self.sql.select_by_id(self._name, obj_id)
+            if len(rows) == 0:
+                raise RowNotFound("No %r with id=%d" %
+                                  (self._row_cls, obj_id))
+            [(data,)] = rows
+            if cache is not None:
+                cache.set((self._name, 'row', obj_id), data, generation)
+        row = self._row(obj_id, data)
+        if identity_map is not None:
+            identity_map[self._name, obj_id] = row
+        return row
+
+    def get_many(self, obj_ids, missing='raise'):
+        """ Fetch the :class:`TableRow` objects with the given ids, using a
+        single query, and return them in the same order as `obj_ids`. The
+        `missing` argument controls what happens with ids that are not
+        found: ``'raise'`` raises `RowNotFound`, ``'skip'`` leaves them out
+        of the result, and ``'none'`` returns `None` in their place. """
+        if missing not in ('raise', 'skip', 'none'):
+            raise ValueError("Unknown missing-row policy %r" % missing)
+        obj_ids = list(obj_ids)
+        identity_map = self._session._identity_map
+        found = {}
+        if identity_map is not None:
+            for obj_id in obj_ids:
+                row = identity_map.get((self._name, obj_id))
+                if row is not None:
+                    found[obj_id] = row
+        to_fetch = set(obj_ids) - set(found)
+        cache = self._session._cache_for(self._name)
+        if cache is not None:
+            for obj_id in list(to_fetch):
+                data = cache.get((self._name, 'row', obj_id))
+                if data is not None:
+                    found[obj_id] = self._row(obj_id, data)
+                    to_fetch.discard(obj_id)
+        if to_fetch:
+            if cache is not None:
+                generation = cache.generation(self._name)
+            for obj_id, data in self.sql.select_by_ids(self._name, to_fetch):
+                row = found[obj_id] = self._row(obj_id, data)
+                if identity_map is not None:
+                    identity_map[self._name, obj_id] = row
+                if cache is not None:
+                    cache.set((self._name, 'row', obj_id), data, generation)
+
+        if missing == 'raise':
+            not_found = [obj_id for obj_id in obj_ids if obj_id not in found]
+            if not_found:
+                raise RowNotFound("No %r with ids %r" %
+                                  (self._row_cls, not_found))
+        elif missing == 'skip':
+            obj_ids = [obj_id for obj_id in obj_ids if obj_id in found]
+        return [found.get(obj_id) for obj_id in obj_ids]
+
+    def _forget(self, obj_id):
+        if self._session._identity_map is not None:
+            self._session._identity_map.pop((self._name, obj_id), None)
+
+    def _forget_all(self):
+        identity_map = self._session._identity_map
+        if identity_map is not None:
+            for key in [key for key in identity_map if key[0] == self._name]:
+                del identity_map[key]
+
+    def update_where(self, where, set=None, unset=()):
+        """ Change all rows that match `where`, with a single `UPDATE`
+        query: keys from the `set` dict are assigned, keys listed in
+        `unset` are removed. Returns the number of rows updated. """
+        changed = dict(set or {})
+        self._check_data(changed)
+        count = self.sql.update_where(self._name, where, changed,
+                                      list(unset))
+        self._forget_all()
+        self._session._wrote(self._name)
+        return count
+
+    def upsert(self, match, data={}):
+        """ Update the row whose values match all the keys of `match`,
+        setting the values from `data`; if there is no such row, insert
+        one with the values of both. Returns a ``(id, created)`` tuple.
+
+        On PostgreSQL this is a single ``INSERT ... ON CONFLICT`` query;
+        `match` must have exactly one key, with a unique index made by
+        ``create_index(key, unique=True)``, or `ValueError` is raised. On
+        SQLite, `match` can have any number of keys; the database is locked
+        for writing during the lookup, and `MultipleRowsFound` is raised if
+        several rows match. """
+        self._check_data(match)
+        self._check_data(data)
+        obj_id, created = self.sql.upsert(self._name, dict(match), dict(data))
+        self._forget(obj_id)
+        self._session._wrote(self._name, obj_id)
+        return obj_id, created
+
+    def delete_where(self, where):
+        """ Delete all rows that match `where`, with a single `DELETE`
+        query. Returns the number of rows deleted. """
+        count = self.sql.delete_where(self._name, where)
+        self._forget_all()
+        self._session._wrote(self._name)
+        return count
 
     def delete(self, obj_id, _deprecation_warning=True):
         if _deprecation_warning:
@@ -478,6 +2223,8 @@ class Table(object):
             warnings.warn(msg, DeprecationWarning, stacklevel=2)
         assert isinstance(obj_id, (int, long))
         self.sql.delete(self._name, obj_id)
+        self._forget(obj_id)
+        self._session._wrote(self._name, obj_id)
 
     def get_all(self, _deprecation_warning=True):
         if _deprecation_warning:
@@ -486,11 +2233,36 @@ class Table(object):
         return self.find()
 
     def query(self, where={}, order_by=None,
-              offset=0, limit=None, count=False):
+              offset=0, limit=None, count=False,
+              stream=False, fetch_size=1000, fields=None):
         """ Same as :meth:`find` but results are clipped with `offset` and
-        `limit`. """
-        results = self.sql.select(self._name, where, order_by,
-                                  offset, limit, count)
+        `limit`. If `stream` is True, rows are fetched from the database in
+        batches of `fetch_size` while iterating, instead of all at once;
+        on PostgreSQL this uses a server-side cursor, which is only valid
+        until the end of the transaction.
+
+        If `fields` is a list of keys, only those keys are loaded. Saving
+        such a partial row only writes the keys that were changed. """
+        cache = None
+        if not stream and fields is None:
+            cache = self._session._cache_for(self._name)
+        if cache is not None:
+            cache_key = _query_cache_key(self._name, where, order_by,
+                                         offset, limit, count)
+            if cache_key is None:
+                cache = None
+        if cache is not None:
+            results = cache.get(cache_key)
+            if results is None:
+                generation = cache.generation(self._name)
+                results = list(self.sql.select(self._name, where, order_by,
+                                               offset, limit, count))
+                cache.set(cache_key, results, generation)
+        else:
+            results = self.sql.select(self._name, where, order_by,
+                                      offset, limit, count,
+                                      fetch_size if stream else None,
+                                      fields=fields)
         if count:
             results = list(results)
             [(num_rows,)] = list(results)
@@ -498,6 +2270,30 @@ class Table(object):
         else:
             return (self._row(id_, data) for id_, data in results)
 
+    def query_page(self, where={}, order_by=None, after=None, limit=100):
+        """ Fetch a page of at most `limit` results of :meth:`query`, and
+        return a ``(rows, next_token)`` tuple. Pass `next_token` as `after`
+        to get the following page, using the same `where` and `order_by`;
+        it's `None` on the last page. Pages are selected by the sort value
+        and `id` of the previous page's last row, so deep pages cost the
+        same as the first one. """
+        if after is not None:
+            ordered = _parse_order_by(order_by)[0] is not None
+            after = _decode_page_token(after, ordered)
+        results = list(self.sql.select(self._name, where, order_by,
+                                       0, limit + 1, False, after=after))
+        rows = [self._row(id_, data) for id_, data in results[:limit]]
+        next_token = None
+        if len(results) > limit:
+            last = rows[-1]
+            sort_field = _parse_order_by(order_by)[0]
+            if sort_field is None:
+                next_token = _encode_page_token([last.id])
+            else:
+                next_token = _encode_page_token([last.get(sort_field),
+                                                 last.id])
+        return rows, next_token
+
     def find(self, **kwargs):
         """ Returns an iterator over all matching :class:`TableRow`
         objects. """
@@ -544,10 +2340,15 @@ class Session(object):
 
     _debug = False
     _dialect_cls = PostgresqlDialect
+    _pool = None
+    _identity_map = None
+    _cache = None
+    _blob_refs_created = False
 
     def __init__(self, schema, conn, debug=False):
         self._schema = schema
         self._conn = conn
+        self._written_tables = set()
 
     @property
     def conn(self):
@@ -559,7 +2360,7 @@ class Session(object):
 
     @property
     def sql(self):
-        return self._dialect_cls(self.conn)
+        return self._dialect_cls(self.conn, self._pool)
 
     def _release_conn(self):
         conn = self._conn
@@ -575,16 +2376,93 @@ class Session(object):
 
     def del_db_file(self, id):
         """ Delete the :class:`DbFile` object with the given `id`. """
+        if self._dedup_blobs and self._release_blob(id):
+            return
         self.conn.lobject(id, mode='n').unlink()
 
+    @property
+    def _dedup_blobs(self):
+        return self._pool is not None and self._pool._dedup_blobs
+
+    def _blob_refs_cursor(self):
+        cursor = self.conn.cursor()
+        # once a session commits the table, the database remembers it
+        if not (self._pool._blob_refs_ready or self._blob_refs_created):
+            cursor.execute("CREATE TABLE IF NOT EXISTS htables_blob_refs ("
+                           "hash TEXT PRIMARY KEY, "
+                           "oid OID NOT NULL UNIQUE, "
+                           "refs INTEGER NOT NULL)")
+            self._blob_refs_created = True
+        return cursor
+
+    def _dedup_blob(self, oid, digest):
+        """ Register large object `oid`, with contents hashed to `digest`,
+        and return the id to use for it: either `oid` or the id of a large
+        object with the same contents, in which case `oid` is deleted. """
+        cursor = self._blob_refs_cursor()
+        # if another session registers the same hash concurrently, this
+        # waits for it to finish, then counts a reference to its blob
+        cursor.execute("INSERT INTO htables_blob_refs AS r (hash, oid, refs) "
+                       "VALUES (%s, %s, 1) ON CONFLICT (hash) "
+                       "DO UPDATE SET refs = r.refs + 1 RETURNING oid",
+                       (digest, oid))
+        [existing_oid] = cursor.fetchone()
+        if existing_oid != oid:
+            self.conn.lobject(oid, mode='n').unlink()
+        return existing_oid
+
+    def _release_blob(self, oid):
+        """ Drop a reference to the large object `oid`, deleting it if it
+        was the last one. Returns False if `oid` is not registered. """
+        cursor = self._blob_refs_cursor()
+        cursor.execute("UPDATE htables_blob_refs SET refs = refs - 1 "
+                       "WHERE oid = %s RETURNING refs", (oid,))
+        row = cursor.fetchone()
+        if row is None:
+            return False
+        if row[0] <= 0:
+            cursor.execute("DELETE FROM htables_blob_refs WHERE oid = %s",
+                           (oid,))
+            self.conn.lobject(oid, mode='n').unlink()
+        return True
+
+    def _clear_identity_map(self):
+        if self._identity_map is not None:
+            self._identity_map.clear()
+
+    def _cache_for(self, table_name):
+        """ The shared :class:`RowCache`, if it can be used for reading
+        `table_name`; this session's uncommitted changes must not be
+        visible to other sessions. """
+        if table_name in self._written_tables:
+            return None
+        return self._cache
+
+    def _wrote(self, table_name, obj_id=None):
+        if self._cache is not None:
+            self._cache.invalidate(table_name, obj_id)
+            self._written_tables.add(table_name)
+
     def commit(self):
         """ Commit the current transaction. """
         self.conn.commit()
+        if self._blob_refs_created:
+            self._pool._blob_refs_ready = True
+            self._blob_refs_created = False
+        self._clear_identity_map()
+        if self._cache is not None:
+            # other sessions may have cached rows before we committed
+            for table_name in self._written_tables:
+                self._cache.invalidate(table_name)
+        self._written_tables.clear()
 
     def rollback(self):
         """ Roll back the current transaction. """
         # TODO needs a unit test
         self.conn.rollback()
+        self._clear_identity_map()
+        self._written_tables.clear()
+        self._blob_refs_created = False
 
     def _table_for_cls(self, obj_or_cls):
         if isinstance(obj_or_cls, TableRow):
@@ -629,6 +2507,8 @@ class Session(object):
         self._conn.commit()
 
     def delete_all_blobs(self):
+        if self._dedup_blobs:
+            self._blob_refs_cursor().execute("DELETE FROM htables_blob_refs")
         cursor = self.conn.cursor()
         cursor.execute("SELECT oid FROM pg_largeobject_metadata")
         for [oid] in cursor:
@@ -649,23 +2529,136 @@ class SqliteDbFile(object):
         self.id = id
         self._data = data
 
-    def save_from(self, in_file):
+    def save_from(self, in_file, chunk_size=COPY_BUFFER_SIZE, compress=None):
+        blocks = _blob_blocks(_iter_file(in_file, chunk_size=chunk_size),
+                              compress)
         self._data.seek(0)
-        self._data.write(in_file.read())
+        self._data.truncate()
+        for block in blocks:
+            self._data.write(block)
 
-    def iter_data(self):
-        return iter([self._data.getvalue()])
+    def iter_data(self, offset=0, length=None, chunk_size=COPY_BUFFER_SIZE):
+        data = StringIO.StringIO(self._data.getvalue())
+        return _iter_blob(data, offset, length, chunk_size)
+
+
+class SqliteDiskDbFile(object):
+    """ Blob stored as a file in the `blob_dir` of a :class:`SqliteDB`;
+    same api as :class:`DbFile`. Unlike PostgreSQL large objects, blob
+    files are not part of database transactions. """
+
+    def __init__(self, session, id, path):
+        self.id = id
+        self._path = path
+
+    def save_from(self, in_file, chunk_size=COPY_BUFFER_SIZE, compress=None):
+        blocks = _blob_blocks(_iter_file(in_file, chunk_size=chunk_size),
+                              compress)
+        # write to a temporary file, so readers never see partial data
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self._path),
+                                        prefix='.tmp-')
+        try:
+            tmp_file = os.fdopen(fd, 'wb')
+            try:
+                for block in blocks:
+                    tmp_file.write(block)
+            finally:
+                tmp_file.close()
+            os.rename(tmp_path, self._path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+    def iter_data(self, offset=0, length=None, chunk_size=COPY_BUFFER_SIZE):
+        data_file = open(self._path, 'rb')
+        return _iter_blob(data_file, offset, length, chunk_size)
+
+    def mmap(self):
+        """ Return a read-only memory map of the file contents, which can
+        be indexed and sliced like a string, without reading the whole
+        file. Close it when done, with its `close` method or in a ``with``
+        block. Compressed blobs can't be mapped. """
+        data_file = open(self._path, 'rb')
+        try:
+            tag, start = _read_blob_header(data_file)
+            if tag != _compression_tags[None]:
+                raise ValueError("Can't map a compressed blob")
+            return _BlobMap(data_file, start)
+        finally:
+            data_file.close()
+
+
+class _BlobMap(object):
+    """ Read-only memory map of the data of a blob file, starting at byte
+    `start`; returned by :meth:`SqliteDiskDbFile.mmap`. """
+
+    def __init__(self, data_file, start):
+        import mmap
+        size = os.fstat(data_file.fileno()).st_size
+        self._start = start
+        self._size = size - start
+        self._map = None  # empty files can't be mapped
+        if size:
+            self._map = mmap.mmap(data_file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._size)
+            if step != 1:
+                return ''.join(self[i] for i in xrange(start, stop, step))
+            if stop <= start:
+                return ''
+            return self._map[self._start + start:self._start + stop]
+        if index < 0:
+            index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError("Index out of range")
+        return self._map[self._start + index]
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 
 class SqliteSession(Session):
 
     _dialect_cls = SqliteDialect
 
+    _blob_dir = None
+
     def __init__(self, schema, conn, db_files, debug=False):
         super(SqliteSession, self).__init__(schema, conn, debug)
         self._db_files = db_files
 
+    def _blob_path(self, id):
+        return os.path.join(self._blob_dir, '%d' % id)
+
     def get_db_file(self, id=None):
+        if self._blob_dir is not None:
+            if id is None:
+                while True:
+                    id = random.randint(1, 2 ** 31)
+                    try:
+                        fd = os.open(self._blob_path(id),
+                                     os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+                    except OSError, e:
+                        import errno
+                        if e.errno != errno.EEXIST:
+                            raise
+                    else:
+                        os.close(fd)
+                        break
+            return SqliteDiskDbFile(self, id, self._blob_path(id))
         if self._db_files is None:
             raise BlobsNotSupported
         if id is None:
@@ -677,24 +2670,64 @@ class SqliteSession(Session):
         return SqliteDbFile(self, id, self._db_files[id])
 
     def del_db_file(self, id):
-        del self._db_files[id]
+        if self._blob_dir is not None:
+            os.unlink(self._blob_path(id))
+        else:
+            del self._db_files[id]
 
     def delete_all_blobs(self):
-        pass
+        if self._blob_dir is not None:
+            for name in os.listdir(self._blob_dir):
+                if name.isdigit():
+                    os.unlink(os.path.join(self._blob_dir, name))
 
     def drop_all(self):
         for table in self._tables():
             table.drop_table()
         self._conn.commit()
-        self._db_files.clear()
+        self.delete_all_blobs()
+        if self._db_files is not None:
+            self._db_files.clear()
 
 
 class SqliteDB(object):
-    """ SQLite database session pool; same api as :class:`PostgresqlDB`. """
+    """ SQLite database session pool; same api as :class:`PostgresqlDB`.
+
+    `pragmas` is a `dict` of ``PRAGMA`` settings applied to each new
+    connection, for example ``{'journal_mode': 'wal', 'synchronous':
+    'normal'}``; `on_connect` is then called with the connection for any
+    other setup. By default each session opens its own connection. If
+    `pool_size` is set, file databases keep up to that many connections in
+    a :class:`ConnectionPool`, reused across sessions and threads; the
+    other `pool_*` arguments work like for :class:`PostgresqlDB`.
+
+    Blobs are kept in memory for ``:memory:`` databases. File databases
+    only support blobs if `blob_dir` is given; each blob is then stored as
+    a file in that folder, which is created if missing.
+
+    `codec` selects how rows are encoded: ``'json'`` (the default) stores
+    JSON text, which SQLite can filter and index; ``'msgpack'`` needs the
+    `msgpack` package, and is faster to encode and decode, but rows are
+    then filtered in Python. Rows saved with any codec or compression remain readable, and
+    can be queried and updated, but only in Python until
+    :meth:`Table.reencode` converts them.
+    """
 
-    def __init__(self, uri, schema=None):
-        import sqlite3
-        self._connect = lambda: sqlite3.connect(uri)
+    def __init__(self, uri, schema=None, identity_map=False, cache=None,
+                 pragmas={}, on_connect=None, pool_size=None,
+                 pool_timeout=30, pool_max_age=None, pool_max_idle=None,
+                 blob_dir=None, codec='json'):
+        if codec not in _row_formats:
+            raise ValueError("Unknown codec %r" % codec)
+        if codec == 'msgpack':
+            _msgpack()  # fail early if it's not installed
+        self._codec = codec
+        self._binary_rows = {}  # table name -> has rows that aren't JSON
+        self._connect = lambda: _sqlite_connect(uri, pragmas, on_connect)
+        self._identity_map = identity_map
+        self._cache = cache
+        self._conn_pool = None
+        self._blob_dir = None
         if uri == ':memory:':
             _single_connection = self._connect()
             self._connect = lambda: _single_connection
@@ -702,16 +2735,50 @@ class SqliteDB(object):
             self._files = {}
         else:
             self._files = None
+            if blob_dir is not None:
+                self._blob_dir = str(blob_dir)
+                if not os.path.isdir(self._blob_dir):
+                    os.makedirs(self._blob_dir)
+            if pool_size:
+                connect = lambda: _sqlite_connect(uri, pragmas, on_connect,
+                                                  check_same_thread=False)
+                self._conn_pool = ConnectionPool(connect,
+                                                 max_size=pool_size,
+                                                 timeout=pool_timeout,
+                                                 max_age=pool_max_age,
+                                                 max_idle=pool_max_idle,
+                                                 reset=self._reset_connection)
+                self._connect = self._conn_pool.getconn
         if schema is None:
             schema = Schema([])
         self.schema = schema
 
     def get_session(self):
-        return SqliteSession(self.schema, self._connect(), self._files)
+        session = SqliteSession(self.schema, self._connect(), self._files)
+        session._pool = self
+        session._blob_dir = self._blob_dir
+        if self._identity_map:
+            session._identity_map = {}
+        session._cache = self._cache
+        return session
+
+    def _reset_connection(self, conn):
+        conn.rollback()
+        return True
 
     def put_session(self, session):
         session.rollback()
-        session._release_conn().close()
+        if self._conn_pool is not None:
+            self._conn_pool.putconn(session._release_conn())
+        else:
+            session._release_conn().close()
+
+    def pool_stats(self):
+        """ Statistics about the connection pool, as returned by
+        :meth:`ConnectionPool.stats`, or `None` if there is no pool. """
+        if self._conn_pool is None:
+            return None
+        return self._conn_pool.stats()
 
     @contextmanager
     def session(self):
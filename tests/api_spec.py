@@ -267,6 +267,82 @@ class _HTablesApiTest(TestCase):
             data = ''.join(db_file.iter_data())
             self.assertEqual(data, "hello large data")
 
+    def test_large_file_is_read_in_chunks(self):
+        data = ''.join(chr(c % 256) for c in range(1000))
+        with self.db_session() as session:
+            db_file = session.get_db_file()
+            db_file.save_from(StringIO(data), chunk_size=300)
+            session.commit()
+            db_file_id = db_file.id
+
+        with self.db_session() as session:
+            db_file = session.get_db_file(db_file_id)
+            chunks = list(db_file.iter_data(chunk_size=400))
+            self.assertEqual([len(chunk) for chunk in chunks], [400, 400, 200])
+            self.assertEqual(''.join(chunks), data)
+
+    def test_large_file_range(self):
+        with self.db_session() as session:
+            db_file = session.get_db_file()
+            db_file.save_from(StringIO("hello large data"))
+            session.commit()
+            db_file_id = db_file.id
+
+        with self.db_session() as session:
+            db_file = session.get_db_file(db_file_id)
+            self.assertEqual(''.join(db_file.iter_data(6, 5)), "large")
+            self.assertEqual(''.join(db_file.iter_data(offset=12)), "data")
+            chunks = list(db_file.iter_data(2, 9, chunk_size=4))
+            self.assertEqual(chunks, ["llo ", "larg", "e"])
+
+    def test_large_file_overwrite(self):
+        with self.db_session() as session:
+            db_file = session.get_db_file()
+            db_file.save_from(StringIO("hello large data"))
+            db_file.save_from(StringIO("bye"))
+            self.assertEqual(''.join(db_file.iter_data()), "bye")
+
+    def test_large_file_starting_with_header(self):
+        import htables
+        data = htables.COMPRESSION_HEADER + "bz not compressed"
+        with self.db_session() as session:
+            db_file = session.get_db_file()
+            db_file.save_from(StringIO(data))
+            self.assertEqual(''.join(db_file.iter_data()), data)
+            self.assertEqual(''.join(db_file.iter_data(3, 2)), "bz")
+
+    def test_large_file_compressed(self):
+        data = "hello large data " * 100
+        with self.db_session() as session:
+            db_file = session.get_db_file()
+            db_file.save_from(StringIO(data), compress='zlib')
+            session.commit()
+            db_file_id = db_file.id
+
+        with self.db_session() as session:
+            db_file = session.get_db_file(db_file_id)
+            self.assertEqual(''.join(db_file.iter_data()), data)
+            self.assertEqual(''.join(db_file.iter_data(6, 5)), "large")
+            chunks = list(db_file.iter_data(1000, chunk_size=300))
+            self.assertEqual([len(chunk) for chunk in chunks], [300, 300, 100])
+            self.assertEqual(''.join(chunks), data[1000:])
+
+    def test_large_file_compressed_range(self):
+        import random
+        rnd = random.Random(13)
+        data = ''.join(chr(rnd.randrange(256)) for c in range(5000))
+        with self.db_session() as session:
+            db_file = session.get_db_file()
+            db_file.save_from(StringIO(data), compress='zlib')
+            chunks = list(db_file.iter_data(0, 1000, chunk_size=300))
+            self.assertEqual([len(chunk) for chunk in chunks],
+                             [300, 300, 300, 100])
+            self.assertEqual(''.join(chunks), data[:1000])
+            chunks = list(db_file.iter_data(100, 1000, chunk_size=300))
+            self.assertEqual(''.join(chunks), data[100:1100])
+            self.assertEqual(''.join(db_file.iter_data(4990, 1000)),
+                             data[4990:])
+
     def test_large_file_error(self):
         import psycopg2
         with self.db_session() as session:
@@ -298,6 +374,34 @@ class _HTablesApiTest(TestCase):
         with self.db_session() as session:
             self.assertEqual(self._count_large_files(session), 0)
 
+    def test_save_writes_only_changed_keys(self):
+        with self.db_session() as session:
+            table = session['person']
+            row_id = table.new(a="1", b="2", c="3").id
+            row1 = table.get(row_id)
+            row2 = table.get(row_id)
+            row1['a'] = "one"
+            del row1['c']
+            row1.save()
+            row2['b'] = "two"
+            row2.save()
+            self.assertEqual(table.get(row_id), {'a': "one", 'b': "two"})
+
+    def test_save_unchanged_row_makes_no_query(self):
+        from mock import patch
+        with self.db_session() as session:
+            table = session['person']
+            row = table.get(table.new(a="1").id)
+            dialect_cls = type(table.sql)
+            with patch.object(dialect_cls, 'update_keys') as update_keys:
+                row.save()
+                row['a'] = "1"
+                row.save()
+                self.assertEqual(update_keys.call_count, 0)
+                row['a'] = "2"
+                row.save()
+                self.assertEqual(update_keys.call_count, 1)
+
     def test_table_access(self):
         with self.db_session() as session:
             session['person'].new(hello="world").save()
@@ -461,6 +565,334 @@ class _HTablesQueryApiTest(TestCase):
         self.assertEqual([row['name'] for row in results],
                          ['row-1', 'row-2', 'row-3', 'row-4'])
 
+    def test_query_with_filter_order_offset_and_limit(self):
+        from htables import op
+        table = self.session['person']
+        for c in range(6):
+            table.new(name="row-%d" % c,
+                      parity="odd" if c%2 else "even")
+        results = list(table.query(where={'parity': "even"},
+                                   order_by=op.Reversed('name'),
+                                   offset=1, limit=1))
+        self.assertEqual(results, [{'name': "row-2", 'parity': "even"}])
+
+    def test_insert_many_returns_ids(self):
+        table = self.session['person']
+        table.new(name="first")
+        ids = table.insert_many({'name': "row-%d" % c} for c in range(5))
+        self.assertEqual(ids, [2, 3, 4, 5, 6])
+        self.assertEqual(table.get(4), {'name': "row-2"})
+
+    def test_insert_many_in_small_batches(self):
+        table = self.session['person']
+        ids = table.insert_many([{'name': "row-%d" % c} for c in range(5)],
+                                batch_size=2)
+        self.assertEqual(ids, [1, 2, 3, 4, 5])
+        self.assertEqual([row['name'] for row in table.find()],
+                         ["row-%d" % c for c in range(5)])
+
+    def test_insert_many_with_no_rows(self):
+        table = self.session['person']
+        self.assertEqual(table.insert_many([]), [])
+
+    def test_stream_query_results(self):
+        table = self.session['person']
+        for c in range(5):
+            table.new(name="row-%d" % c,
+                      parity="odd" if c%2 else "even")
+        results = table.query(where={'parity': "even"}, order_by='name',
+                              stream=True, fetch_size=2)
+        self.assertEqual([row['name'] for row in results],
+                         ['row-0', 'row-2', 'row-4'])
+
+    def test_stream_count(self):
+        table = self.session['person']
+        for c in range(5):
+            table.new(name="row-%d" % c)
+        self.assertEqual(table.query(count=True, stream=True), 5)
+
+    def _names(self, where):
+        table = self.session['person']
+        return sorted(row['name'] for row in table.query(where=where))
+
+    def _add_people(self):
+        table = self.session['person']
+        table.new(name="ann", born="1990-05-01", tag="a%b")
+        table.new(name="bob", born="1985-01-20", tag="axb")
+        table.new(name="cid", born="2001-12-31", tag="A%B")
+        table.new(name="dan")
+
+    def test_query_with_in_operator(self):
+        from htables import op
+        self._add_people()
+        self.assertEqual(self._names({'name': op.In(["ann", "cid", "x"])}),
+                         ["ann", "cid"])
+        self.assertEqual(self._names({'name': op.In([])}), [])
+
+    def test_query_with_not_equal_operator(self):
+        from htables import op
+        self._add_people()
+        self.assertEqual(self._names({'tag': op.Ne("axb")}),
+                         ["ann", "cid", "dan"])
+
+    def test_query_with_comparison_operators(self):
+        from htables import op
+        self._add_people()
+        self.assertEqual(self._names({'born': op.Gt("1990-05-01")}),
+                         ["cid"])
+        self.assertEqual(self._names({'born': op.Ge("1990-05-01")}),
+                         ["ann", "cid"])
+        self.assertEqual(self._names({'born': op.Lt("1990-05-01")}),
+                         ["bob"])
+        self.assertEqual(self._names({'born': op.Le("1990-05-01")}),
+                         ["ann", "bob"])
+
+    def test_query_with_range_operator(self):
+        from htables import op
+        self._add_people()
+        self.assertEqual(self._names({'born': op.Range("1985", "2000")}),
+                         ["ann", "bob"])
+        self.assertEqual(self._names({'born': op.Range(start="1990")}),
+                         ["ann", "cid"])
+        self.assertEqual(self._names({'born': op.Range(end="1990")}),
+                         ["bob"])
+
+    def test_query_with_prefix_operator(self):
+        from htables import op
+        self._add_people()
+        self.assertEqual(self._names({'born': op.Prefix("19")}),
+                         ["ann", "bob"])
+        self.assertEqual(self._names({'tag': op.Prefix("a%")}), ["ann"])
+        self.assertEqual(self._names({'tag': op.Prefix("a_")}), [])
+        self.assertEqual(self._names({'tag': op.Prefix("")}),
+                         ["ann", "bob", "cid"])
+
+    def test_query_with_exists_operator(self):
+        from htables import op
+        self._add_people()
+        self.assertEqual(self._names({'born': op.Exists()}),
+                         ["ann", "bob", "cid"])
+        self.assertEqual(self._names({'nothing': op.Exists()}), [])
+
+    def test_query_with_or(self):
+        from htables import op
+        self._add_people()
+        where = op.Or({'name': "ann"}, {'born': op.Prefix("20")})
+        self.assertEqual(self._names(where), ["ann", "cid"])
+        self.assertEqual(self._names(op.Or({'name': "dan"}, {})),
+                         ["ann", "bob", "cid", "dan"])
+        self.assertEqual(self._names(op.Or()), [])
+        table = self.session['person']
+        self.assertEqual(table.query(where=where, count=True), 2)
+
+    def test_query_with_or_and_regexp(self):
+        from htables import op
+        self._add_people()
+        where = op.Or({'name': op.RE("^d")}, {'tag': "axb"})
+        self.assertEqual(self._names(where), ["bob", "dan"])
+
+    def test_query_selected_fields(self):
+        from htables import op
+        table = self.session['person']
+        table.new(name="one", color="red", size="1")
+        table.new(name="two", size="2")
+        table.new(name="three", color="blue", size="3")
+        results = table.query(where={'size': op.RE('[23]')},
+                              order_by=op.Reversed('size'),
+                              fields=['name', 'color'])
+        self.assertEqual(list(results), [{'name': "three", 'color': "blue"},
+                                         {'name': "two"}])
+
+    def test_save_partial_row_keeps_other_fields(self):
+        table = self.session['person']
+        row_id = table.new(name="one", color="red").id
+        [row] = table.query(fields=['name'])
+        self.assertEqual(row.id, row_id)
+        row['name'] = "two"
+        row.save()
+        self.assertEqual(table.get(row_id), {'name': "two", 'color': "red"})
+
+    def test_update_where(self):
+        table = self.session['person']
+        table.new(name="one", color="red", size="1")
+        table.new(name="two", color="red")
+        table.new(name="three", color="blue", size="3")
+        count = table.update_where({'color': "red"}, set={'color': "pink"},
+                                   unset=['size'])
+        self.assertEqual(count, 2)
+        self.assertEqual([dict(row) for row in table.query(order_by='name')],
+                         [{'name': "one", 'color': "pink"},
+                          {'name': "three", 'color': "blue", 'size': "3"},
+                          {'name': "two", 'color': "pink"}])
+
+    def test_update_where_with_regexp(self):
+        from htables import op
+        table = self.session['person']
+        table.new(name="one")
+        table.new(name="two")
+        table.new(name="three")
+        self.assertEqual(table.update_where({'name': op.RE('^t')},
+                                            set={'t': "yes"}), 2)
+        self.assertEqual(sorted(row['name'] for row in table.find(t="yes")),
+                         ["three", "two"])
+
+    def test_delete_where(self):
+        from htables import op
+        table = self.session['person']
+        table.new(name="one", color="red")
+        table.new(name="two", color="red")
+        table.new(name="three", color="blue")
+        self.assertEqual(table.delete_where({'color': "red",
+                                             'name': op.RE('o$')}), 1)
+        self.assertEqual(table.delete_where({'color': "blue"}), 1)
+        self.assertEqual([row['name'] for row in table.find()], ["one"])
+        self.assertEqual(table.delete_where({}), 1)
+        self.assertEqual(table.query(count=True), 0)
+
+    def _all_pages(self, table, **kwargs):
+        pages = []
+        token = None
+        while True:
+            rows, token = table.query_page(after=token, **kwargs)
+            pages.append([row['name'] for row in rows])
+            if token is None:
+                return pages
+
+    def test_query_page_by_id(self):
+        table = self.session['person']
+        for c in range(5):
+            table.new(name="row-%d" % c)
+        self.assertEqual(self._all_pages(table, limit=2),
+                         [['row-0', 'row-1'], ['row-2', 'row-3'], ['row-4']])
+
+    def test_query_page_with_filter_and_order(self):
+        table = self.session['person']
+        for name, letter, parity in [('a', 'x', 'even'), ('b', 'y', 'odd'),
+                                     ('c', 'x', 'odd'), ('d', 'w', 'odd'),
+                                     ('e', 'y', 'odd'), ('f', 'x', 'odd')]:
+            table.new(name=name, letter=letter, parity=parity)
+        pages = self._all_pages(table, where={'parity': 'odd'},
+                                order_by='letter', limit=2)
+        self.assertEqual(pages, [['d', 'c'], ['f', 'b'], ['e']])
+
+    def test_query_page_reversed_with_missing_values(self):
+        from htables import op
+        table = self.session['person']
+        table.new(name='a', letter='x')
+        table.new(name='b')
+        table.new(name='c', letter='y')
+        table.new(name='d')
+        table.new(name='e', letter='x')
+        expected = [row['name'] for row in
+                    table.query(order_by=op.Reversed('letter'))]
+        for limit in [1, 2, 3]:
+            pages = self._all_pages(table, order_by=op.Reversed('letter'),
+                                    limit=limit)
+            self.assertEqual(sum(pages, []), expected)
+
+    def test_query_page_with_missing_values(self):
+        table = self.session['person']
+        table.new(name='a', letter='x')
+        table.new(name='b')
+        table.new(name='c', letter='w')
+        table.new(name='d')
+        expected = [row['name'] for row in table.query(order_by='letter')]
+        pages = self._all_pages(table, order_by='letter', limit=1)
+        self.assertEqual(sum(pages, []), expected)
+
+    def test_query_page_exact_fit_has_no_next_token(self):
+        table = self.session['person']
+        for c in range(2):
+            table.new(name="row-%d" % c)
+        rows, token = table.query_page(limit=2)
+        self.assertEqual(len(rows), 2)
+        self.assertIsNone(token)
+
+    def test_query_page_with_invalid_token(self):
+        table = self.session['person']
+        self.assertRaises(ValueError, table.query_page, after='not a token')
+
+    def test_query_page_with_malformed_token(self):
+        import base64
+        import json
+        table = self.session['person']
+        token = lambda value: base64.urlsafe_b64encode(json.dumps(value))
+        for after in [{}, [], [1, 2, 3], ["1"], [1.5], [True], [None]]:
+            self.assertRaises(ValueError, table.query_page,
+                              after=token(after))
+        for after in [[1], ["a", "1"], [None, 1, 2]]:
+            self.assertRaises(ValueError, table.query_page,
+                              order_by='name', after=token(after))
+        table.new(name="a")
+        self.assertEqual(table.query_page(order_by='name',
+                                          after=token([None, 0]))[0],
+                         [{'name': "a"}])
+
+    def test_get_many_returns_rows_in_requested_order(self):
+        table = self.session['person']
+        for c in range(4):
+            table.new(name="row-%d" % c)
+        rows = table.get_many([3, 1, 4, 1])
+        self.assertEqual([row['name'] for row in rows],
+                         ['row-2', 'row-0', 'row-3', 'row-0'])
+        self.assertEqual([row.id for row in rows], [3, 1, 4, 1])
+
+    def test_get_many_with_missing_ids(self):
+        from htables import RowNotFound
+        table = self.session['person']
+        table.new(name="row-0")
+        self.assertRaises(RowNotFound, table.get_many, [1, 13])
+        rows = table.get_many([13, 1], missing='skip')
+        self.assertEqual(rows, [{'name': "row-0"}])
+        rows = table.get_many([13, 1], missing='none')
+        self.assertEqual(rows, [None, {'name': "row-0"}])
+
+    def test_get_many_with_no_ids(self):
+        self.assertEqual(self.session['person'].get_many([]), [])
+
+    def test_list_indexes(self):
+        table = self.session['person']
+        self.assertEqual(table.list_indexes(), [])
+        table.create_index('email')
+        table.create_index("it's")
+        self.assertEqual(sorted(table.list_indexes()), ['email', "it's"])
+        table.drop_index('email')
+        self.assertEqual(table.list_indexes(), ["it's"])
+
+    def test_unique_index(self):
+        table = self.session['person']
+        table.create_index('email', unique=True)
+        self.assertEqual(table.list_indexes(), ['email'])
+        table.new(email="a@example.com")
+        table.new(name="no email")
+        table.new(name="no email either")
+        self.assertRaises(Exception, table.new, email="a@example.com")
+
+    def test_upsert(self):
+        table = self.session['person']
+        table.create_index('email', unique=True)
+        other_id = table.new(email="b@example.com", name="B").id
+        row_id, created = table.upsert({'email': "a@example.com"},
+                                       {'name': "A", 'age': "1"})
+        self.assertTrue(created)
+        self.assertEqual(table.upsert({'email': "a@example.com"},
+                                      {'age': "2"}), (row_id, False))
+        self.assertEqual(table.get(row_id), {'email': "a@example.com",
+                                             'name': "A", 'age': "2"})
+        self.assertEqual(table.get(other_id), {'email': "b@example.com",
+                                               'name': "B"})
+
+    def test_filter_and_order_with_index(self):
+        from htables import op
+        table = self.session['person']
+        table.create_index('letter')
+        table.new(name="row-1", letter='a')
+        table.new(name="row-2", letter='b')
+        table.new(name="row-3", letter='a')
+        results = table.query(where={'letter': 'a'},
+                              order_by=op.Reversed('name'))
+        self.assertEqual([row['name'] for row in results], ['row-3', 'row-1'])
+
     def test_count_with_no_filter_returns_4(self):
         table = self.session['person']
         for c in range(4):
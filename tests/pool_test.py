@@ -0,0 +1,128 @@
+from __future__ import with_statement
+import threading
+import time
+from common import TestCase
+
+
+class FakeConnection(object):
+
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTest(TestCase):
+
+    def create_pool(self, **kwargs):
+        import htables
+        self.opened = []
+
+        def connect():
+            conn = FakeConnection()
+            self.opened.append(conn)
+            return conn
+
+        return htables.ConnectionPool(connect, **kwargs)
+
+    def test_returned_connection_is_reused(self):
+        pool = self.create_pool()
+        conn = pool.getconn()
+        pool.putconn(conn)
+        self.assertIs(pool.getconn(), conn)
+        self.assertEqual(len(self.opened), 1)
+
+    def test_min_size_connections_are_opened_upfront(self):
+        pool = self.create_pool(min_size=2)
+        self.assertEqual(len(self.opened), 2)
+        self.assertEqual(pool.stats()['idle'], 2)
+
+    def test_full_pool_times_out(self):
+        import htables
+        pool = self.create_pool(max_size=1, timeout=0.01)
+        pool.getconn()
+        self.assertRaises(htables.PoolTimeout, pool.getconn)
+        self.assertEqual(pool.stats()['checkout_failures'], 1)
+
+    def test_full_pool_waits_for_returned_connection(self):
+        pool = self.create_pool(max_size=1, timeout=5)
+        conn = pool.getconn()
+        timer = threading.Timer(0.05, pool.putconn, [conn])
+        timer.start()
+        self.addCleanup(timer.join)
+        self.assertIs(pool.getconn(), conn)
+        self.assertTrue(pool.stats()['max_wait_time'] > 0)
+
+    def test_old_connections_are_recycled(self):
+        pool = self.create_pool(max_age=0.01)
+        conn = pool.getconn()
+        time.sleep(0.02)
+        pool.putconn(conn)
+        self.assertTrue(conn.closed)
+        self.assertIsNot(pool.getconn(), conn)
+
+    def test_idle_connections_are_recycled(self):
+        pool = self.create_pool(max_idle=0.01)
+        conn = pool.getconn()
+        pool.putconn(conn)
+        time.sleep(0.02)
+        self.assertIsNot(pool.getconn(), conn)
+        self.assertTrue(conn.closed)
+
+    def test_idle_connections_are_kept_up_to_min_size(self):
+        pool = self.create_pool(min_size=1, max_idle=0.01)
+        [conn] = self.opened
+        time.sleep(0.02)
+        self.assertIs(pool.getconn(), conn)
+
+    def test_invalid_connection_is_replaced_on_checkout(self):
+        pool = self.create_pool(validate=lambda conn: not conn.closed)
+        conn = pool.getconn()
+        pool.putconn(conn)
+        conn.closed = True
+        self.assertIsNot(pool.getconn(), conn)
+        self.assertEqual(pool.stats()['discarded'], 1)
+
+    def test_connection_that_fails_validation_with_error_is_replaced(self):
+        def validate(conn):
+            if conn.closed:
+                raise IOError("connection is closed")
+            return True
+
+        pool = self.create_pool(max_size=1, timeout=0.01, validate=validate)
+        conn = pool.getconn()
+        pool.putconn(conn)
+        conn.closed = True
+        new_conn = pool.getconn()
+        self.assertIsNot(new_conn, conn)
+        pool.putconn(new_conn)
+        self.assertIs(pool.getconn(), new_conn)
+        self.assertEqual(pool.stats()['discarded'], 1)
+
+    def test_connection_that_fails_reset_is_closed(self):
+        pool = self.create_pool(reset=lambda conn: False)
+        conn = pool.getconn()
+        pool.putconn(conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool.stats()['idle'], 0)
+
+    def test_failed_connect_frees_its_slot(self):
+        import htables
+
+        def connect():
+            raise IOError
+
+        pool = htables.ConnectionPool(connect, max_size=1, timeout=0.01)
+        self.assertRaises(IOError, pool.getconn)
+        self.assertRaises(IOError, pool.getconn)
+        self.assertEqual(pool.stats()['checkout_failures'], 2)
+
+    def test_stats(self):
+        pool = self.create_pool()
+        conn1 = pool.getconn()
+        pool.getconn()
+        pool.putconn(conn1)
+        stats = pool.stats()
+        self.assertEqual(stats['in_use'], 1)
+        self.assertEqual(stats['idle'], 1)
+        self.assertEqual(stats['checkouts'], 2)
@@ -21,6 +21,97 @@ class PostgresqQueryApiTest(api_spec._HTablesQueryApiTest):
         import htables
         return htables.PostgresqlDB(CONNECTION_URI, debug=True)
 
+    def spy_queries(self):
+        import htables
+        queries = []
+
+        class SpyDialect(htables.PostgresqlDialect):
+            def execute(self, *args, **kwargs):
+                queries.append(args[0])
+                return super(SpyDialect, self).execute(*args, **kwargs)
+
+        self.session._dialect_cls = SpyDialect
+        return queries
+
+    def test_new_row_is_inserted_with_one_query(self):
+        table = self.session['person']
+        queries = self.spy_queries()
+        row = table.new(name="one")
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(table.get(row.id), {'name': "one"})
+
+    def test_save_sends_only_the_changes(self):
+        table = self.session['person']
+        row = table.get(table.new(name="one", color="red").id)
+        queries = self.spy_queries()
+        row['name'] = "two"
+        del row['color']
+        row.save()
+        self.assertEqual(queries, ["UPDATE person SET data = "
+                                   "delete(data, %s::text[]) || %s "
+                                   "WHERE id = %s"])
+        self.assertEqual(table.get(row.id), {'name': "two"})
+
+    def test_upsert_with_several_keys(self):
+        table = self.session['person']
+        self.assertRaises(ValueError, table.upsert,
+                          {'name': "one", 'color': "red"}, {'size': "1"})
+
+    def test_whole_row_index_is_listed(self):
+        table = self.session['person']
+        table.create_index()
+        self.assertEqual(table.list_indexes(), [None])
+        table.drop_index()
+        self.assertEqual(table.list_indexes(), [])
+
+    def test_whole_row_index_and_index_on_data_key(self):
+        table = self.session['person']
+        table.create_index('data')
+        table.create_index()
+        self.assertEqual(sorted(table.list_indexes()), [None, 'data'])
+        table.drop_index()
+        self.assertEqual(table.list_indexes(), ['data'])
+
+    def test_filter_with_whole_row_index_uses_containment(self):
+        table = self.session['person']
+        table.create_index()
+        table.create_index('name')
+        table.new(name="one", color="red")
+        table.new(name="two", color="red")
+        sql = self.session.sql
+        self.assertEqual(sql._compile_where('person', {'color': "red"}),
+                         (["data @> hstore(ARRAY['color'], %s)"], [["red"]]))
+        self.assertEqual(sql._compile_where('person', {'name': "one"}),
+                         (["((data -> 'name') COLLATE \"C\") = %s"],
+                          ["one"]))
+        results = table.find(color="red", name="two")
+        self.assertEqual(list(results), [{'name': "two", 'color': "red"}])
+
+    def _query_plan(self, sql, params=()):
+        cursor = self.session.conn.cursor()
+        # the table is tiny, so the planner would rather scan it
+        cursor.execute("SET LOCAL enable_seqscan = off")
+        cursor.execute("EXPLAIN " + sql, params)
+        return ' '.join(row[0] for row in cursor)
+
+    def test_range_prefix_and_order_use_index(self):
+        from htables import op
+        table = self.session['person']
+        table.create_index('born')
+        table.insert_many({'born': str(1900 + c)} for c in range(100))
+        for where in [{'born': op.Prefix("19")},
+                      {'born': op.Range("1990", "2000")}]:
+            conditions, params = self.session.sql._compile_where('person',
+                                                                 where)
+            plan = self._query_plan("SELECT id FROM person WHERE " +
+                                    " AND ".join(conditions), params)
+            self.assertIn("person_born_idx", plan)
+        plan = self._query_plan("SELECT id FROM person ORDER BY "
+                                "((data -> 'born') COLLATE \"C\") LIMIT 10")
+        self.assertIn("person_born_idx", plan)
+        rows = table.query(where={'born': op.Prefix("195")})
+        self.assertEqual(len(list(rows)), 10)
+
 
 def insert_spy(obj, attr_name):
     original_callable = getattr(obj, attr_name)
@@ -70,3 +161,139 @@ class PostgresqlSessionTest(unittest.TestCase):
         conn = session._conn
         db.put_session(session)
         self.assertEqual(spy.mock_calls, [call(conn)])
+
+    def test_identity_map_returns_same_row_object(self):
+        import htables
+        db = htables.PostgresqlDB(CONNECTION_URI, identity_map=True)
+        with db.session() as session:
+            table = session['person']
+            table.create_table()
+            row = table.new(name="one")
+            self.assertIs(table.get(row.id), table.get(row.id))
+            session.rollback()
+
+    def test_connection_is_set_up_once(self):
+        import psycopg2.extras
+        spy = insert_spy(psycopg2.extras, 'register_hstore')
+        self.addCleanup(setattr, psycopg2.extras, 'register_hstore',
+                        spy.side_effect)
+        connections = []
+        db = self.get_db()
+        db._on_connect = connections.append
+        for c in range(3):
+            with db.session() as session:
+                session.commit()
+        self.assertEqual(len(spy.mock_calls), 1)
+        self.assertEqual(len(connections), 1)
+
+    def test_hstore_oids_are_looked_up_once(self):
+        from psycopg2.extras import HstoreAdapter
+        self.addCleanup(setattr, HstoreAdapter, 'get_oids',
+                        HstoreAdapter.__dict__['get_oids'])
+        spy = insert_spy(HstoreAdapter, 'get_oids')
+        db = self.get_db()
+        with db.session() as session1:
+            with db.session() as session2:
+                session1.commit()
+                session2.commit()
+        self.assertEqual(len(spy.mock_calls), 1)
+
+    def test_pool_stats(self):
+        db = self.get_db()
+        with db.session() as session:
+            session.commit()
+            self.assertEqual(db.pool_stats()['in_use'], 1)
+        stats = db.pool_stats()
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['idle'], 1)
+
+    def test_full_pool_times_out(self):
+        import htables
+        db = htables.PostgresqlDB(CONNECTION_URI, pool_size=1,
+                                  pool_timeout=0.01)
+        with db.session():
+            self.assertRaises(htables.PoolTimeout, db.get_session)
+
+    def test_returned_connection_is_rolled_back(self):
+        db = self.get_db()
+        with db.session() as session:
+            session.conn.cursor().execute("SELECT 1")
+            conn = session.conn
+        with db.session() as session:
+            self.assertIs(session.conn, conn)
+            self.assertEqual(conn.get_transaction_status(), 0)
+
+
+class PostgresqlPreparedQueryApiTest(api_spec._HTablesQueryApiTest):
+
+    def create_db(self):
+        import htables
+        return htables.PostgresqlDB(CONNECTION_URI, debug=True, prepare=True)
+
+    def test_query_is_prepared_once(self):
+        table = self.session['person']
+        table.new(name="one")
+        table.new(name="two")
+        self.assertEqual(list(table.find(name="one")), [{'name': "one"}])
+        self.assertEqual(list(table.find(name="two")), [{'name': "two"}])
+        self.assertEqual(len(self.session.conn._htables_statements), 1)
+
+    def test_percent_sign_in_prepared_query(self):
+        table = self.session['person']
+        table.new({'100%': "a%b"})
+        self.assertEqual(list(table.find(**{'100%': "a%b"})),
+                         [{'100%': "a%b"}])
+
+
+class PostgresqlDedupBlobTest(api_spec._HTablesApiTest):
+
+    def create_db(self):
+        import htables
+        return htables.PostgresqlDB(CONNECTION_URI, debug=True,
+                                    dedup_blobs=True)
+
+    def save_blob(self, session, data):
+        from StringIO import StringIO
+        db_file = session.get_db_file()
+        db_file.save_from(StringIO(data))
+        return db_file.id
+
+    def test_identical_blobs_are_stored_once(self):
+        with self.db_session() as session:
+            id1 = self.save_blob(session, "hello large data")
+            id2 = self.save_blob(session, "hello large data")
+            id3 = self.save_blob(session, "other data")
+            self.assertEqual(id1, id2)
+            self.assertNotEqual(id1, id3)
+            self.assertEqual(self._count_large_files(session), 2)
+
+    def test_refs_table_is_created_once(self):
+        with self.db_session() as session:
+            self.save_blob(session, "hello large data")
+            session.commit()
+        self.assertTrue(self.db._blob_refs_ready)
+        with self.db_session() as session:
+            session.del_db_file(self.save_blob(session, "other data"))
+            self.assertFalse(session._blob_refs_created)
+
+    def test_blob_is_deleted_with_last_reference(self):
+        with self.db_session() as session:
+            id1 = self.save_blob(session, "hello large data")
+            self.save_blob(session, "hello large data")
+            session.del_db_file(id1)
+            data = ''.join(session.get_db_file(id1).iter_data())
+            self.assertEqual(data, "hello large data")
+            session.del_db_file(id1)
+            self.assertEqual(self._count_large_files(session), 0)
+
+    def test_overwrite_shared_blob_keeps_other_reference(self):
+        from StringIO import StringIO
+        with self.db_session() as session:
+            id1 = self.save_blob(session, "hello large data")
+            db_file = session.get_db_file(id1)
+            self.save_blob(session, "hello large data")
+            db_file.save_from(StringIO("bye"))
+            self.assertNotEqual(db_file.id, id1)
+            self.assertEqual(''.join(db_file.iter_data()), "bye")
+            data = ''.join(session.get_db_file(id1).iter_data())
+            self.assertEqual(data, "hello large data")
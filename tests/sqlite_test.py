@@ -2,6 +2,7 @@ from __future__ import with_statement
 from contextlib import contextmanager
 import sqlite3
 import tempfile
+import zlib
 import simplejson as json
 from common import TestCase
 import api_spec
@@ -22,25 +23,72 @@ class SqliteApiTest(api_spec._HTablesApiTest):
         import htables
         temp_db = tempfile.NamedTemporaryFile()
         self.addCleanup(temp_db.close)
-        return htables.SqliteDB(temp_db.name)
+        self.blob_dir = self.tmpdir() / 'blobs'
+        return htables.SqliteDB(temp_db.name, blob_dir=self.blob_dir)
 
     def _unpack_data(self, value):
         return json.loads(value)
 
     def _count_large_files(self, session):
-        return len(self.db._files)
+        return len(self.blob_dir.listdir())
 
     def test_large_file_error(self):
-        from nose import SkipTest
-        raise SkipTest
-
-    def test_large_file(self):
-        from nose import SkipTest
-        raise SkipTest
-
-    def test_remove_large_file(self):
-        from nose import SkipTest
-        raise SkipTest
+        with self.db_session() as session:
+            db_file = session.get_db_file(13)
+            with self.assertRaises(IOError):
+                ''.join(db_file.iter_data())
+
+    def test_large_file_mmap(self):
+        from StringIO import StringIO
+        with self.db_session() as session:
+            db_file = session.get_db_file()
+            db_file.save_from(StringIO("hello large data"))
+            data = db_file.mmap()
+            self.assertEqual(len(data), 16)
+            self.assertEqual(data[6:11], "large")
+            self.assertEqual(data[-4:], "data")
+            self.assertEqual(data[0], "h")
+            self.assertEqual(data[::5], "h ea")
+            self.assertRaises(IndexError, lambda: data[16])
+            data.close()
+            with session.get_db_file().mmap() as empty:
+                self.assertEqual(len(empty), 0)
+                self.assertEqual(empty[:], '')
+
+    def test_large_file_starting_with_header_mmap(self):
+        import htables
+        from StringIO import StringIO
+        data = htables.COMPRESSION_HEADER + "bz not compressed"
+        with self.db_session() as session:
+            db_file = session.get_db_file()
+            db_file.save_from(StringIO(data))
+            with db_file.mmap() as mapped:
+                self.assertEqual(mapped[:], data)
+
+    def test_large_file_without_header(self):
+        with self.db_session() as session:
+            db_file = session.get_db_file()
+            f = open(self.blob_dir / str(db_file.id), 'wb')
+            f.write("saved by an older version")
+            f.close()
+            self.assertEqual(''.join(db_file.iter_data(6, 2)), "by")
+            with db_file.mmap() as mapped:
+                self.assertEqual(mapped[:5], "saved")
+
+    def test_compressed_large_file_mmap(self):
+        from StringIO import StringIO
+        with self.db_session() as session:
+            db_file = session.get_db_file()
+            db_file.save_from(StringIO("hello large data"), compress='zlib')
+            self.assertRaises(ValueError, db_file.mmap)
+
+    def test_delete_all_large_files(self):
+        from StringIO import StringIO
+        with self.db_session() as session:
+            for c in range(2):
+                session.get_db_file().save_from(StringIO("data"))
+            session.delete_all_blobs()
+            self.assertEqual(self._count_large_files(session), 0)
 
 
 class SqliteQueryApiTest(api_spec._HTablesQueryApiTest):
@@ -51,6 +99,178 @@ class SqliteQueryApiTest(api_spec._HTablesQueryApiTest):
         self.addCleanup(temp_db.close)
         return htables.SqliteDB(temp_db.name)
 
+    def test_count_with_offset_and_limit(self):
+        table = self.session['person']
+        for c in range(4):
+            table.new(name="row-%d" % c)
+        self.assertEqual(table.query(offset=1, limit=2, count=True), 2)
+        self.assertEqual(table.query(offset=3, limit=2, count=True), 1)
+
+    def test_query_selected_fields_keeps_json_types(self):
+        table = self.session['person']
+        table.new(name="one", tags=["a", "b"], info={'x': 1}, age=3,
+                  ok=True, none=None)
+        fields = ['tags', 'info', 'age', 'ok', 'none', 'missing']
+        [row] = table.query(fields=fields)
+        self.assertEqual(row, {'tags': ["a", "b"], 'info': {'x': 1},
+                               'age': 3, 'ok': True, 'none': None})
+        self.assertTrue(row['ok'] is True)
+
+    def test_query_selected_fields_that_are_not_json_paths(self):
+        table = self.session['person']
+        table.new({'a"b': "one", 'name': "x"})
+        self.assertEqual(list(table.query(fields=['a"b'])), [{'a"b': "one"}])
+
+    def test_whole_row_index_is_not_supported(self):
+        table = self.session['person']
+        self.assertRaises(ValueError, table.create_index)
+        self.assertRaises(ValueError, table.drop_index)
+
+    def test_upsert_with_several_matches(self):
+        from htables import MultipleRowsFound
+        table = self.session['person']
+        table.new(name="one", color="red")
+        table.new(name="two", color="red")
+        self.assertRaises(MultipleRowsFound, table.upsert,
+                          {'color': "red"}, {'size': "1"})
+
+    def test_upsert_locks_database_before_lookup(self):
+        import htables
+        queries = []
+
+        class SpyDialect(htables.SqliteDialect):
+            def execute(self, *args):
+                queries.append(args[0])
+                return super(SpyDialect, self).execute(*args)
+
+        self.session._dialect_cls = SpyDialect
+        self.session['person'].upsert({'name': "one"})
+        self.assertEqual(queries[0], "UPDATE person SET id = id WHERE 0")
+        self.assertTrue([q for q in queries[1:]
+                         if q.startswith("SELECT id, data FROM person")])
+
+    def test_upsert_without_index(self):
+        table = self.session['person']
+        self.assertEqual(table.upsert({'name': "one"}), (1, True))
+        self.assertEqual(table.upsert({'name': "one"}), (1, False))
+
+    def test_range_and_prefix_use_index(self):
+        from htables import op
+        table = self.session['person']
+        table.create_index('born')
+        for where in [{'born': op.Prefix("19")},
+                      {'born': op.Range("1990", "2000")}]:
+            conditions, params, matchers = \
+                self.session.sql._compile_where('person', where)
+            self.assertEqual(matchers, [])
+            plan = self.session.conn.execute(
+                "EXPLAIN QUERY PLAN SELECT id FROM person WHERE " +
+                " AND ".join(conditions), params).fetchall()
+            self.assertIn("person_born_idx", str(plan))
+
+    def test_filter_on_key_that_is_not_a_json_path(self):
+        table = self.session['person']
+        table.new({'a"b': "one"})
+        table.new({'a"b': "two"})
+        self.assertEqual(list(table.find(**{'a"b': "two"})), [{'a"b': "two"}])
+
+    def test_order_by_key_that_is_not_a_json_path(self):
+        table = self.session['person']
+        table.new({'a"b': "2", 'name': "x"})
+        table.new({'a"b': "1", 'name': "x"})
+        table.new({'a"b': "3", 'name': "y"})
+        results = table.query(where={'name': "x"}, order_by='a"b', limit=1)
+        self.assertEqual(list(results), [{'a"b': "1", 'name': "x"}])
+
+    def test_query_page_ordered_by_key_that_is_not_a_json_path(self):
+        table = self.session['person']
+        for value in ["2", "1", "2", "3"]:
+            table.new({'a"b': value})
+        rows, token = table.query_page(order_by='a"b', limit=2)
+        self.assertEqual([row.id for row in rows], [2, 1])
+        rows, token = table.query_page(order_by='a"b', limit=2, after=token)
+        self.assertEqual([row.id for row in rows], [3, 4])
+        self.assertIsNone(token)
+
+    def test_query_page_ordered_by_values_that_are_not_strings(self):
+        from htables import op
+        table = self.session['person']
+        for value in [True, None, "b", 3, False, [1, 2], {'a': 1}, None,
+                      2.5, [1, 2], True]:
+            table.new({'v': value})
+        for order_by in ['v', op.Reversed('v')]:
+            expected = [row.id for row in table.query(order_by=order_by)]
+            for limit in [1, 2, 3]:
+                ids = []
+                token = None
+                while True:
+                    rows, token = table.query_page(order_by=order_by,
+                                                   limit=limit, after=token)
+                    ids.extend(row.id for row in rows)
+                    if token is None:
+                        break
+                self.assertEqual(ids, expected)
+
+    def test_regexp_on_missing_key_matches_empty_string(self):
+        from htables import op
+        table = self.session['person']
+        table.new(name="one")
+        table.new()
+        self.assertEqual(table.query(where={'name': op.RE('^$')},
+                                     count=True), 1)
+
+    def test_insert_many_above_sqlite_variable_limit(self):
+        table = self.session['person']
+        ids = table.insert_many({'n': str(c)} for c in range(1200))
+        self.assertEqual(ids, range(1, 1201))
+        self.assertEqual(table.get(1200), {'n': "1199"})
+
+    def test_get_many_above_sqlite_variable_limit(self):
+        table = self.session['person']
+        table.insert_many({'n': str(c)} for c in range(1200))
+        rows = table.get_many(range(1200, 0, -1))
+        self.assertEqual(rows[0], {'n': "1199"})
+        self.assertEqual(len(rows), 1200)
+
+    def _query_plan(self, sql):
+        cursor = self.session.conn.execute("EXPLAIN QUERY PLAN " + sql)
+        return ' '.join(row[-1] for row in cursor)
+
+    def test_index_is_used_for_filtering(self):
+        table = self.session['person']
+        table.create_index('email')
+        table.new(email="a@example.com")
+        table.new(email="b@example.com")
+        plan = self._query_plan("SELECT id FROM person "
+                                "WHERE json_extract(data, '$.\"email\"') = 1")
+        self.assertIn("USING INDEX person_email_idx", plan)
+        self.assertEqual(list(table.find(email="b@example.com")),
+                         [{'email': "b@example.com"}])
+
+    def test_drop_index(self):
+        table = self.session['person']
+        table.create_index('email')
+        table.drop_index('email')
+        plan = self._query_plan("SELECT id FROM person "
+                                "WHERE json_extract(data, '$.\"email\"') = 1")
+        self.assertNotIn("INDEX", plan)
+
+    def test_index_on_key_with_special_characters(self):
+        table = self.session['person']
+        table.create_index('e-mail')
+        table.create_index('e.mail')
+        table.new({'e-mail': "a", 'e.mail': "b"})
+        self.assertEqual(table.query(where={'e-mail': "a"}, count=True), 1)
+        self.assertEqual(table.query(where={'e.mail': "b"}, count=True), 1)
+
+    def test_filter_is_done_in_sql(self):
+        table = self.session['person']
+        table.new(name="one")
+        table.new(name="two")
+        self.session.conn.execute("UPDATE person SET data = '[1]' "
+                                  "WHERE id = 1")
+        self.assertEqual(list(table.find(name="two")), [{'name': "two"}])
+
 
 class SqliteApiMemoryTest(api_spec._HTablesApiTest):
 
@@ -121,8 +341,524 @@ class SqliteSessionTest(TestCase):
         self.assertRaises(sqlite3.ProgrammingError, connection.cursor)
         self.assertRaises(RuntimeError, lambda: session.conn)
 
+    def create_pooled_db(self, **kwargs):
+        import htables
+        db_path = self.tmpdir() / 'db.sqlite'
+        return htables.SqliteDB(db_path, schema=self.schema, pool_size=2,
+                                **kwargs)
+
+    def test_pooled_consecutive_access(self):
+        db = self.create_pooled_db()
+        self.assert_consecutive_sessions_access_same_database(db)
+
+    def test_pooled_sessions_reuse_connection(self):
+        db = self.create_pooled_db()
+        with db_session(db) as session:
+            connection = session.conn
+        with db_session(db) as session:
+            self.assertIs(session.conn, connection)
+        self.assertRaises(RuntimeError, lambda: session.conn)
+        self.assertEqual(db.pool_stats()['idle'], 1)
+
+    def test_pooled_sessions_use_different_connections(self):
+        db = self.create_pooled_db()
+        with db_session(db) as session1:
+            session1.create_all()
+            session1.commit()
+            with db_session(db) as session2:
+                session1['person'].new(name="Joe")
+                self.assertEqual(list(session2['person'].find()), [])
+
+    def test_pooled_connection_is_rolled_back(self):
+        db = self.create_pooled_db()
+        with db_session(db) as session:
+            session.create_all()
+            session.commit()
+            session['person'].new(name="Joe")
+        with db_session(db) as session:
+            self.assertEqual(list(session['person'].find()), [])
+
+    def test_pragmas_and_setup_hook(self):
+        connections = []
+        db = self.create_pooled_db(pragmas={'journal_mode': 'wal',
+                                            'cache_size': -4000},
+                                   on_connect=connections.append)
+        for c in range(2):
+            with db_session(db) as session:
+                cursor = session.conn.execute("PRAGMA journal_mode")
+                self.assertEqual(cursor.fetchone()[0], 'wal')
+                cursor = session.conn.execute("PRAGMA cache_size")
+                self.assertEqual(cursor.fetchone()[0], -4000)
+        self.assertEqual(len(connections), 1)
+
+    def test_create_all_creates_declared_indexes(self):
+        import htables
+        schema = htables.Schema()
+        schema.define_table('Person', 'person', indexes=['email'])
+        db = htables.SqliteDB(':memory:', schema=schema)
+        with db_session(db) as session:
+            session.create_all()
+            self.assertEqual(session['person'].list_indexes(), ['email'])
+
     def test_filesystem_db_does_not_support_blobs(self):
         import htables
         db = self.create_filesystem_db()
         with db_session(db) as session:
             self.assertRaises(htables.BlobsNotSupported, session.get_db_file)
+
+
+class SqliteCompressionTest(TestCase):
+
+    def setUp(self):
+        import htables
+        schema = htables.Schema()
+        schema.define_table('Person', 'person', compress='zlib')
+        self.db = htables.SqliteDB(':memory:', schema=schema)
+        self.session = self.db.get_session()
+        self.session.create_all()
+
+    def test_rows_are_stored_compressed(self):
+        import htables
+        table = self.session['person']
+        row = table.new(bio="lorem ipsum " * 100)
+        [(data,)] = self.session.conn.execute("SELECT data FROM person")
+        self.assertTrue(str(data).startswith(htables.COMPRESSION_HEADER))
+        self.assertTrue(len(data) < 200)
+        self.assertEqual(table.get(row.id), {'bio': "lorem ipsum " * 100})
+
+    def test_query_compressed_rows(self):
+        table = self.session['person']
+        table.new(name="one", age="2")
+        table.new(name="two", age="1")
+        self.assertEqual([r['name'] for r in table.find(name="two")], ["two"])
+        rows = table.query(order_by='age')
+        self.assertEqual([r['name'] for r in rows], ["two", "one"])
+
+    def test_uncompressed_rows_are_still_readable(self):
+        self.session.conn.execute("INSERT INTO person (data) "
+                                  "VALUES ('{\"name\": \"old\"}')")
+        table = self.session['person']
+        table.new(name="new")
+        self.assertEqual([r['name'] for r in table.find()], ["old", "new"])
+        self.assertEqual(list(table.find(name="old")), [{'name': "old"}])
+
+    def test_unknown_compression(self):
+        import htables
+        schema = htables.Schema()
+        schema.define_table('Person', 'person', compress='foo')
+        db = htables.SqliteDB(':memory:', schema=schema)
+        with db_session(db) as session:
+            session.create_all()
+            self.assertRaises(ValueError, session['person'].new, name="one")
+
+
+class SqliteConfigChangeTest(TestCase):
+
+    def setUp(self):
+        self.db_path = self.tmpdir() / 'db.sqlite'
+
+    def create_db(self, **kwargs):
+        import htables
+        return htables.SqliteDB(self.db_path, **kwargs)
+
+    def test_compressed_rows_after_compression_is_turned_off(self):
+        import htables
+        schema = htables.Schema()
+        schema.define_table('Person', 'person', compress='zlib')
+        with db_session(self.create_db(schema=schema)) as session:
+            session['person'].create_table()
+            session['person'].new(name="one", age="2")
+            session['person'].new(name="two", age="1")
+            session.commit()
+
+        with db_session(self.create_db()) as session:
+            table = session['person']
+            table.new(name="three", age="3")
+            self.assertEqual(list(table.find(name="two")),
+                             [{'name': "two", 'age': "1"}])
+            rows = table.query(order_by='age')
+            self.assertEqual([r['name'] for r in rows],
+                             ["two", "one", "three"])
+            row = table.find_single(name="one")
+            row['age'] = "4"
+            row.save()
+            self.assertEqual(table.update_where({'name': "two"},
+                                                set={'age': "5"}), 1)
+            self.assertEqual(table.get(row.id), {'name': "one", 'age': "4"})
+            self.assertEqual(list(table.find(age="5")),
+                             [{'name': "two", 'age': "5"}])
+            table.reencode()
+            [(count,)] = session.conn.execute(
+                "SELECT COUNT(*) FROM person WHERE typeof(data) = 'text'")
+            self.assertEqual(count, 3)
+            self.assertEqual(list(table.find(name="two")),
+                             [{'name': "two", 'age': "5"}])
+
+    def test_msgpack_rows_after_switching_back_to_json(self):
+        require_msgpack()
+        with db_session(self.create_db(codec='msgpack')) as session:
+            session['person'].create_table()
+            session['person'].new(name="one", age="2")
+            session['person'].new(name="two", age="1")
+            session.commit()
+
+        with db_session(self.create_db()) as session:
+            table = session['person']
+            self.assertEqual([r['name'] for r in table.query(order_by='age')],
+                             ["two", "one"])
+            row = table.find_single(name="one")
+            row['age'] = "3"
+            row.save()
+            self.assertEqual(table.update_where({'name': "two"},
+                                                set={'age': "4"}), 1)
+            self.assertEqual(list(table.find(age="4")),
+                             [{'name': "two", 'age': "4"}])
+            self.assertEqual(table.get(row.id), {'name': "one", 'age': "3"})
+            session.commit()
+
+
+def require_msgpack():
+    try:
+        import msgpack
+    except ImportError:
+        from nose import SkipTest
+        raise SkipTest("msgpack is not installed")
+
+
+class SqliteMsgpackApiTest(api_spec._HTablesApiTest):
+
+    def create_db(self):
+        import htables
+        require_msgpack()
+        return htables.SqliteDB(':memory:', codec='msgpack')
+
+    def _unpack_data(self, value):
+        import htables
+        return htables.SqliteDialect(None)._load(value)
+
+    def _count_large_files(self, session):
+        return len(self.db._files)
+
+    def test_large_file_error(self):
+        from nose import SkipTest
+        raise SkipTest
+
+
+class SqliteMsgpackQueryApiTest(api_spec._HTablesQueryApiTest):
+
+    def create_db(self):
+        import htables
+        require_msgpack()
+        return htables.SqliteDB(':memory:', codec='msgpack')
+
+    def test_list_indexes(self):
+        from nose import SkipTest
+        raise SkipTest  # binary rows can't be indexed
+
+    def test_filter_and_order_with_index(self):
+        from nose import SkipTest
+        raise SkipTest
+
+    def test_unique_index(self):
+        from nose import SkipTest
+        raise SkipTest
+
+    def test_upsert(self):
+        from nose import SkipTest
+        raise SkipTest
+
+
+class SqliteCodecTest(TestCase):
+
+    def test_msgpack_loads_unicode_strings(self):
+        import htables
+        require_msgpack()
+        fmt, dumps, loads = htables._row_formats['msgpack']
+        data = loads(dumps({'name': 'Joe', u'bio': u'J\xf6e'}))
+        self.assertEqual(data, {u'name': u'Joe', u'bio': u'J\xf6e'})
+        for value in data.keys() + data.values():
+            self.assertTrue(isinstance(value, unicode))
+
+    def test_unknown_codec(self):
+        import htables
+        self.assertRaises(ValueError, htables.SqliteDB, ':memory:',
+                          codec='foo')
+        self.assertRaises(ValueError, htables.SqliteDB, ':memory:',
+                          codec='stringmap')
+
+    def test_reencode(self):
+        import htables
+        require_msgpack()
+        db_path = self.tmpdir() / 'db.sqlite'
+        db = htables.SqliteDB(db_path)
+        with db_session(db) as session:
+            session['person'].create_table()
+            session['person'].new(name="one")
+            session['person'].new(name="two")
+            session.commit()
+
+        db = htables.SqliteDB(db_path, codec='msgpack')
+        with db_session(db) as session:
+            table = session['person']
+            table.new(name="three")
+            self.assertEqual([r['name'] for r in table.find()],
+                             ["one", "two", "three"])
+            table.reencode(batch_size=2)
+            [(data,)] = session.conn.execute("SELECT data FROM person "
+                                             "WHERE id = 1")
+            self.assertTrue(str(data).startswith(htables.COMPRESSION_HEADER))
+            self.assertEqual(table.get(1), {'name': "one"})
+
+
+class BlobStreamTest(TestCase):
+
+    def test_slice_large_block_into_small_chunks(self):
+        import htables
+        block = ''.join(chr(c % 256) for c in range(1 << 20))
+        chunks = list(htables._slice_blocks(iter([block, "end"]), 3,
+                                            None, 16))
+        self.assertEqual(len(chunks), len(block) // 16)
+        self.assertEqual(set(len(chunk) for chunk in chunks), set([16]))
+        self.assertEqual(''.join(chunks), block[3:] + "end")
+
+    def test_decompress_in_bounded_blocks(self):
+        import htables
+        from StringIO import StringIO
+        compressed = zlib.compress('\0' * (1 << 22))
+        src_file = StringIO(compressed)
+        blocks = list(htables._decompress_blocks(src_file, 'z', 1000))
+        self.assertTrue(max(len(block) for block in blocks) <= 1000)
+        self.assertEqual(''.join(blocks), '\0' * (1 << 22))
+        self.assertTrue(src_file.closed)
+
+
+class SqliteIdentityMapTest(TestCase):
+
+    def setUp(self):
+        import htables
+        self.db = htables.SqliteDB(':memory:', identity_map=True)
+        self.session = self.db.get_session()
+        self.session['person'].create_table()
+        self.addCleanup(self.db.put_session, self.session)
+
+    def test_get_returns_same_row_object(self):
+        table = self.session['person']
+        row = table.new(name="one")
+        self.assertIs(table.get(row.id), table.get(row.id))
+
+    def test_get_does_not_query_again(self):
+        table = self.session['person']
+        row = table.new(name="one")
+        table.get(row.id)
+        self.session.conn.execute("DELETE FROM person")
+        self.assertEqual(table.get(row.id), {'name': "one"})
+
+    def test_save_invalidates_row(self):
+        table = self.session['person']
+        row_id = table.new(name="one").id
+        row = table.get(row_id)
+        row['name'] = "two"
+        row.save()
+        other = table.get(row_id)
+        self.assertIsNot(other, row)
+        self.assertEqual(other, {'name': "two"})
+
+    def test_update_where_invalidates_rows(self):
+        table = self.session['person']
+        row_id = table.new(name="one").id
+        table.get(row_id)
+        table.update_where({'name': "one"}, set={'name': "two"})
+        self.assertEqual(table.get(row_id), {'name': "two"})
+
+    def test_delete_invalidates_row(self):
+        import htables
+        table = self.session['person']
+        row_id = table.new(name="one").id
+        table.get(row_id).delete()
+        self.assertRaises(htables.RowNotFound, table.get, row_id)
+
+    def test_commit_and_rollback_clear_identity_map(self):
+        table = self.session['person']
+        row_id = table.new(name="one").id
+        row = table.get(row_id)
+        self.session.commit()
+        self.assertIsNot(table.get(row_id), row)
+        row = table.get(row_id)
+        self.session.rollback()
+        self.assertIsNot(table.get(row_id), row)
+
+    def test_get_many_uses_identity_map(self):
+        table = self.session['person']
+        row_id = table.new(name="one").id
+        row = table.get(row_id)
+        other_id = table.new(name="two").id
+        [first, second] = table.get_many([row_id, other_id])
+        self.assertIs(first, row)
+        self.assertIs(table.get(other_id), second)
+
+    def test_identity_map_is_disabled_by_default(self):
+        import htables
+        db = htables.SqliteDB(':memory:')
+        session = db.get_session()
+        table = session['person']
+        table.create_table()
+        row_id = table.new(name="one").id
+        self.assertIsNot(table.get(row_id), table.get(row_id))
+
+
+class SqliteRowCacheTest(TestCase):
+
+    def setUp(self):
+        import htables
+        self.cache = htables.RowCache(max_size=10)
+        db_path = self.tmpdir() / 'db.sqlite'
+        self.db = htables.SqliteDB(db_path, cache=self.cache)
+        with db_session(self.db) as session:
+            session['person'].create_table()
+            session['person'].new(name="one")
+            session['person'].new(name="two")
+            session.commit()
+
+    def break_database(self, session):
+        session.conn.execute("DROP TABLE person")
+
+    def test_get_is_served_from_cache(self):
+        with db_session(self.db) as session:
+            session['person'].get(1)
+        with db_session(self.db) as session:
+            self.break_database(session)
+            self.assertEqual(session['person'].get(1), {'name': "one"})
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.cache.misses, 1)
+
+    def test_query_is_served_from_cache(self):
+        with db_session(self.db) as session:
+            list(session['person'].find(name="two"))
+        with db_session(self.db) as session:
+            self.break_database(session)
+            rows = list(session['person'].find(name="two"))
+            self.assertEqual(rows, [{'name': "two"}])
+            self.assertEqual(rows[0].id, 2)
+
+    def test_query_with_operators_is_served_from_cache(self):
+        from htables import op
+        where = op.Or({'name': op.In(["one", "three"])},
+                      {'name': op.Prefix("tw")})
+        with db_session(self.db) as session:
+            list(session['person'].query(where=where))
+        with db_session(self.db) as session:
+            self.break_database(session)
+            rows = list(session['person'].query(where=where))
+            self.assertEqual(rows, [{'name': "one"}, {'name': "two"}])
+
+    def test_row_read_before_invalidation_is_not_cached(self):
+        import htables
+        from mock import patch
+        select_by_id = htables.SqliteDialect.select_by_id
+
+        def select_then_invalidate(dialect, name, obj_id):
+            rows = select_by_id(dialect, name, obj_id)
+            self.cache.invalidate(name, obj_id)
+            return rows
+
+        with db_session(self.db) as session:
+            with patch.object(htables.SqliteDialect, 'select_by_id',
+                              select_then_invalidate):
+                self.assertEqual(session['person'].get(1), {'name': "one"})
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+    def test_cached_rows_are_copies(self):
+        with db_session(self.db) as session:
+            row = session['person'].get(1)
+            row['name'] = "changed"
+            self.assertEqual(session['person'].get(1), {'name': "one"})
+
+    def test_write_invalidates_cache(self):
+        with db_session(self.db) as session:
+            self.assertEqual(session['person'].query(count=True), 2)
+            session['person'].get(1)
+            row = session['person'].get(1)
+            row['name'] = "changed"
+            row.save()
+            self.assertEqual(session['person'].get(1), {'name': "changed"})
+            session['person'].new(name="three")
+            self.assertEqual(session['person'].query(count=True), 3)
+            session.commit()
+        with db_session(self.db) as session:
+            self.assertEqual(session['person'].get(1), {'name': "changed"})
+
+    def test_uncommitted_changes_are_not_cached(self):
+        with db_session(self.db) as session:
+            session['person'].new(name="three")
+            self.assertEqual(session['person'].query(count=True), 3)
+            session.rollback()
+        with db_session(self.db) as session:
+            self.assertEqual(session['person'].query(count=True), 2)
+
+    def test_commit_invalidates_rows_cached_by_other_sessions(self):
+        with db_session(self.db) as session1:
+            row = session1['person'].get(1)
+            row['name'] = "changed"
+            row.save()
+            with db_session(self.db) as session2:
+                self.assertEqual(session2['person'].get(1), {'name': "one"})
+            session1.commit()
+        with db_session(self.db) as session:
+            self.assertEqual(session['person'].get(1), {'name': "changed"})
+
+    def test_get_many_uses_cache(self):
+        with db_session(self.db) as session:
+            session['person'].get(1)
+            rows = session['person'].get_many([1, 2])
+            self.assertEqual(rows, [{'name': "one"}, {'name': "two"}])
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.cache.stats()['size'], 2)
+
+
+class RowCacheTest(TestCase):
+
+    def test_least_recently_used_entry_is_evicted(self):
+        import htables
+        cache = htables.RowCache(max_size=2)
+        cache.set(('t', 'row', 1), 'a')
+        cache.set(('t', 'row', 2), 'b')
+        cache.get(('t', 'row', 1))
+        cache.set(('t', 'row', 3), 'c')
+        self.assertEqual(cache.get(('t', 'row', 2)), None)
+        self.assertEqual(cache.get(('t', 'row', 1)), 'a')
+        self.assertEqual(cache.get(('t', 'row', 3)), 'c')
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_entries_expire(self):
+        import htables
+        cache = htables.RowCache(ttl=-1)
+        cache.set(('t', 'row', 1), 'a')
+        self.assertEqual(cache.get(('t', 'row', 1)), None)
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_invalidate_row_keeps_other_rows(self):
+        import htables
+        cache = htables.RowCache()
+        cache.set(('t', 'row', 1), 'a')
+        cache.set(('t', 'row', 2), 'b')
+        cache.set(('t', 'query', ()), 'c')
+        cache.set(('u', 'row', 1), 'd')
+        cache.invalidate('t', 1)
+        self.assertEqual(cache.get(('t', 'row', 1)), None)
+        self.assertEqual(cache.get(('t', 'row', 2)), 'b')
+        self.assertEqual(cache.get(('t', 'query', ())), None)
+        self.assertEqual(cache.get(('u', 'row', 1)), 'd')
+
+    def test_set_skips_value_read_before_invalidation(self):
+        import htables
+        cache = htables.RowCache()
+        generation = cache.generation('t')
+        cache.invalidate('t', 1)
+        cache.set(('t', 'row', 1), 'a', generation)
+        self.assertEqual(cache.get(('t', 'row', 1)), None)
+        generation = cache.generation('t')
+        cache.clear()
+        cache.set(('t', 'row', 1), 'a', generation)
+        self.assertEqual(cache.get(('t', 'row', 1)), None)
+        cache.set(('t', 'row', 1), 'a', cache.generation('t'))
+        self.assertEqual(cache.get(('t', 'row', 1)), 'a')